@@ -0,0 +1,29 @@
+# Generated by Django 2.2.9 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+def fill_telegram_uid(apps, schema_editor):
+    User = apps.get_model('accounts', 'User')
+    UserSocialAuth = apps.get_model('social_django', 'UserSocialAuth')
+    users = []
+    for user_id, uid in UserSocialAuth.objects.filter(provider='telegram').values_list('user_id', 'uid'):
+        users.append(User(pk=user_id, telegram_uid=uid))
+    User.objects.bulk_update(users, ['telegram_uid'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_user_telegram_chat_id'),
+        ('social_django', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='telegram_uid',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True),
+        ),
+        migrations.RunPython(fill_telegram_uid, migrations.RunPython.noop),
+    ]
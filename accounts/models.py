@@ -2,7 +2,9 @@ from typing import Optional
 
 from django.contrib.auth.models import AbstractUser, UserManager
 from django.db import models
-from django.utils.functional import cached_property
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from model_utils import FieldTracker
 from social_django.models import UserSocialAuth
 
 from lunchegram import bot
@@ -10,25 +12,24 @@ from lunchegram import bot
 
 class CustomUserManager(UserManager):
     def get_from_telegram_uid(self, uid: int) -> Optional['User']:
-        social_user = UserSocialAuth.objects.get_social_auth('telegram', uid)
-        if social_user:
-            return social_user.user
-        return None
+        return self.filter(telegram_uid=str(uid)).first()
 
 
 class User(AbstractUser):
     has_telegram = models.BooleanField(default=False)
     telegram_chat_id = models.CharField(max_length=255, blank=True, null=True)
+    # Copy of uid of the Telegram social account, so that messages can be sent without joining social_auth
+    telegram_uid = models.CharField(max_length=255, blank=True, null=True, db_index=True)
 
     objects = CustomUserManager()
-
-    @cached_property
-    def telegram_account(self):
-        try:
-            account = self.social_auth.filter(provider='telegram').first()
-        except UserSocialAuth.DoesNotExist:
-            account = None
-        return account
+    tracker = FieldTracker(fields=['telegram_uid'])
 
     def send_message(self, text):
         bot.send_message(self.telegram_chat_id, text)
+
+
+@receiver(post_delete, sender=UserSocialAuth)
+def clear_telegram_uid(sender, instance: UserSocialAuth, **kwargs):
+    """Disconnected Telegram account must not be used to send messages anymore."""
+    if instance.provider == 'telegram':
+        User.objects.filter(pk=instance.user_id, telegram_uid=instance.uid).update(telegram_uid=None)
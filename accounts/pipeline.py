@@ -13,3 +13,9 @@ def fill_telegram_chat_id(backend, user, uid, response, *args, **kwargs):
             pass
         else:
             user.telegram_chat_id = chat.chat_id
+
+
+def fill_telegram_uid(backend, user, uid, response, *args, **kwargs):
+    if backend.name == 'telegram' and user.telegram_uid != str(uid):
+        user.telegram_uid = str(uid)
+        user.save(update_fields=['telegram_uid'])
@@ -1,3 +1,56 @@
+from importlib import import_module
+from unittest import mock
+
+from django.apps import apps
 from django.test import TestCase
+from social_django.models import UserSocialAuth
+
+from accounts.factories import UserFactory
+from accounts.models import User
+from accounts.pipeline import fill_telegram_uid
+
+
+class FillTelegramUidTestCase(TestCase):
+    @mock.patch('core.telegram.user_cache.telegram_user_cache')
+    def test_pipeline(self, telegram_user_cache):
+        user = UserFactory.create()
+        backend = mock.Mock()
+        backend.name = 'github'
+        fill_telegram_uid(backend, user, 100, {})
+        user.refresh_from_db()
+        self.assertIsNone(user.telegram_uid)
+
+        backend.name = 'telegram'
+        fill_telegram_uid(backend, user, 100, {})
+        user.refresh_from_db()
+        self.assertEqual(user.telegram_uid, '100')
+
+        # Unchanged uid isn't saved again
+        with self.assertNumQueries(0):
+            fill_telegram_uid(backend, user, 100, {})
+
+    @mock.patch('core.telegram.user_cache.telegram_user_cache')
+    def test_migration(self, telegram_user_cache):
+        users = UserFactory.create_batch(3)
+        UserSocialAuth.objects.create(user=users[0], provider='telegram', uid='100', extra_data={})
+        UserSocialAuth.objects.create(user=users[1], provider='github', uid='200', extra_data={})
+        migration = import_module('accounts.migrations.0003_user_telegram_uid')
+        migration.fill_telegram_uid(apps, None)
+        self.assertEqual(
+            dict(User.objects.filter(pk__in=[u.pk for u in users]).values_list('pk', 'telegram_uid')),
+            {users[0].pk: '100', users[1].pk: None, users[2].pk: None},
+        )
+
+    @mock.patch('core.telegram.user_cache.telegram_user_cache')
+    def test_disconnect(self, telegram_user_cache):
+        user = UserFactory.create(telegram_uid='100')
+        github = UserSocialAuth.objects.create(user=user, provider='github', uid='100', extra_data={})
+        telegram = UserSocialAuth.objects.create(user=user, provider='telegram', uid='100', extra_data={})
 
-# Create your tests here.
+        github.delete()
+        user.refresh_from_db()
+        self.assertEqual(user.telegram_uid, '100')
+        telegram.delete()
+        user.refresh_from_db()
+        self.assertIsNone(user.telegram_uid)
+        telegram_user_cache.invalidate.assert_called_with('100')
@@ -8,7 +8,7 @@ from core.models import Company
 class CompanyForm(forms.ModelForm):
     class Meta:
         model = Company
-        fields = ['name', 'privacy_mode', 'lunches_enabled']
+        fields = ['name', 'privacy_mode', 'lunches_enabled', 'pair_decay_days', 'repeat_pair_penalty']
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
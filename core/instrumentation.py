@@ -0,0 +1,153 @@
+"""
+Timings and counters of weekly pipeline stages.
+
+Last values of every stage are kept in Redis for the Prometheus endpoint,
+stages of a `PipelineRun` are saved to the database as its summary.
+"""
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+
+import attr
+from django.db import connection
+from redis import RedisError
+
+METRICS_KEY = 'pipeline:metrics'
+COUNTERS_KEY = 'metrics:counters'
+
+METRICS = [
+    ('duration', 'lunchegram_stage_duration_seconds', 'Duration of the last run of the stage'),
+    ('queries', 'lunchegram_stage_queries', 'SQL queries made by the last run of the stage'),
+    ('rows_read', 'lunchegram_stage_rows_read', 'Rows selected by the last run of the stage'),
+    ('rows_written', 'lunchegram_stage_rows_written', 'Rows inserted, updated or deleted by the last run of the stage'),
+    ('telegram_calls', 'lunchegram_stage_telegram_calls', 'Telegram API calls made by the last run of the stage'),
+    ('telegram_errors', 'lunchegram_stage_telegram_errors', 'Failed Telegram API calls of the last run of the stage'),
+]
+
+COUNTERS = [
+    ('duplicate_updates', 'lunchegram_duplicate_updates_total', 'Updates re-delivered by Telegram and dropped'),
+]
+
+_active_stages: List['StageStats'] = []
+_lock = threading.Lock()
+
+
+@attr.s(slots=True)
+class StageStats:
+    name = attr.ib(type=str)
+    run_id = attr.ib(default=None)
+    company_id = attr.ib(default=None)
+    duration = attr.ib(type=float, default=0.0)
+    queries = attr.ib(type=int, default=0)
+    rows_read = attr.ib(type=int, default=0)
+    rows_written = attr.ib(type=int, default=0)
+    telegram_calls = attr.ib(type=int, default=0)
+    telegram_errors = attr.ib(type=int, default=0)
+
+    def count_query(self, execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        self.queries += 1
+        rowcount = max(context['cursor'].rowcount, 0)
+        if sql.lstrip()[:6].upper() == 'SELECT':
+            self.rows_read += rowcount
+        else:
+            self.rows_written += rowcount
+        return result
+
+
+@contextmanager
+def stage(name: str, run_id: int = None, company_id: int = None):
+    """Measures duration, queries and Telegram calls of the block and saves them as a pipeline stage."""
+    stats = StageStats(name, run_id, company_id)
+    started_at = time.monotonic()
+    with _lock:
+        _active_stages.append(stats)
+    try:
+        with connection.execute_wrapper(stats.count_query):
+            yield stats
+    finally:
+        stats.duration = time.monotonic() - started_at
+        with _lock:
+            _active_stages.remove(stats)
+        save_stage(stats)
+
+
+def record_stage(name: str, run_id: int = None, company_id: int = None, duration: float = 0.0):
+    """Saves a stage measured somewhere else, e.g. in another process."""
+    save_stage(StageStats(name, run_id, company_id, duration=duration))
+
+
+def record_telegram_call(error: bool = False):
+    """Counts Telegram API call in all stages running in this process."""
+    with _lock:
+        for stats in _active_stages:
+            stats.telegram_calls += 1
+            if error:
+                stats.telegram_errors += 1
+
+
+def save_stage(stats: StageStats):
+    # Imported here because the bot counts its calls with this module before apps are loaded
+    from core.models import PipelineStage
+    from core.utils import get_redis
+
+    values = attr.asdict(stats)
+    del values['run_id'], values['company_id']
+    field = f'{stats.name}:{stats.company_id or ""}'
+    try:
+        pipeline = get_redis().pipeline(transaction=False)
+        pipeline.hset(METRICS_KEY, field, json.dumps(values))
+        pipeline.hincrby(f'{METRICS_KEY}:runs', field, 1)
+        pipeline.execute()
+    except RedisError:
+        logging.exception(f'Metrics of stage `{stats.name}` were not saved')
+
+    if stats.run_id is not None:
+        PipelineStage.objects.create(run_id=stats.run_id, company_id=stats.company_id, **values)
+
+
+def increment_counter(name: str, amount: int = 1):
+    from core.utils import get_redis
+
+    try:
+        get_redis().hincrby(COUNTERS_KEY, name, amount)
+    except RedisError:
+        logging.exception(f'Counter `{name}` was not incremented')
+
+
+def _format_labels(name: str, company_id: Optional[str]) -> str:
+    labels = f'stage="{name}"'
+    if company_id:
+        labels += f',company="{company_id}"'
+    return '{' + labels + '}'
+
+
+def render_metrics() -> str:
+    """Returns last stage values and counters in Prometheus text format."""
+    from core.utils import get_redis
+
+    redis = get_redis()
+    stages = {}
+    for field, value in redis.hgetall(METRICS_KEY).items():
+        name, _, company_id = field.decode('utf-8').rpartition(':')
+        stages[_format_labels(name, company_id)] = json.loads(value)
+    runs = {}
+    for field, value in redis.hgetall(f'{METRICS_KEY}:runs').items():
+        name, _, company_id = field.decode('utf-8').rpartition(':')
+        runs[_format_labels(name, company_id)] = int(value)
+
+    lines = []
+    for key, metric, help_text in METRICS:
+        lines += [f'# HELP {metric} {help_text}.', f'# TYPE {metric} gauge']
+        lines += [f'{metric}{labels} {values[key]}' for labels, values in sorted(stages.items())]
+    lines += ['# HELP lunchegram_stage_runs_total Number of runs of the stage.', '# TYPE lunchegram_stage_runs_total counter']
+    lines += [f'lunchegram_stage_runs_total{labels} {count}' for labels, count in sorted(runs.items())]
+
+    counters = redis.hgetall(COUNTERS_KEY)
+    for key, metric, help_text in COUNTERS:
+        lines += [f'# HELP {metric} {help_text}.', f'# TYPE {metric} counter']
+        lines.append(f'{metric} {int(counters.get(key.encode("utf-8"), 0))}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,76 @@
+import json
+import time
+
+import telebot
+from django.core.management.base import BaseCommand
+
+from core.telegram.router import Router
+
+COMMANDS = [['groups'], ['join'], ['offline'], ['online'], ['test'], ['help', 'start']]
+CALLBACKS = ['offline', 'online']
+
+UPDATES = {
+    'command': {'message': {'text': '/online'}},
+    'text': {'message': {'text': 'invite-token'}},
+    'callback': {'callback_query': {'id': '1', 'chat_instance': '1', 'data': 'online:1'}},
+}
+
+
+def make_update(update_id: int, kind: str) -> telebot.types.Update:
+    data = {'update_id': update_id}
+    for key, value in UPDATES[kind].items():
+        user = {'id': 1, 'is_bot': False, 'first_name': 'John'}
+        value = dict(value, **{'from': user})
+        if key == 'message':
+            value.update(message_id=update_id, date=0, chat={'id': 1, 'type': 'private'})
+        data[key] = value
+    return telebot.types.Update.de_json(data)
+
+
+def make_handler_list_bot() -> telebot.TeleBot:
+    """Bot with handlers registered the way callbacks did before the router."""
+    bot = telebot.TeleBot('0:benchmark', threaded=False)
+    for commands in COMMANDS:
+        bot.message_handler(commands=commands)(lambda message: None)
+    for prefix in CALLBACKS:
+        bot.callback_query_handler(func=lambda c, prefix=prefix: c.data.startswith(prefix))(lambda query: None)
+    bot.message_handler(func=lambda message: True, content_types=['text'])(lambda message: None)
+    return bot
+
+
+def make_router_bot() -> telebot.TeleBot:
+    bot = telebot.TeleBot('0:benchmark', threaded=False)
+    router = Router()
+    for commands in COMMANDS:
+        router.command(*commands)(lambda message: None)
+    for prefix in CALLBACKS:
+        router.callback(prefix)(lambda query, argument: None)
+    router.fallback(lambda message: None)
+    router.install(bot)
+    return bot
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures dispatch overhead per update of bot handlers without handler bodies. '
+        'Prints one JSON object per dispatcher and update kind.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--updates', type=int, default=10000, help='Updates of every kind to dispatch')
+
+    def handle(self, *args, **options):
+        for dispatcher, make_bot in [('handler_list', make_handler_list_bot), ('router', make_router_bot)]:
+            bot = make_bot()
+            for kind in UPDATES:
+                updates = [make_update(i, kind) for i in range(options['updates'])]
+                started_at = time.perf_counter()
+                for update in updates:
+                    bot.process_new_updates([update])
+                seconds = time.perf_counter() - started_at
+                self.stdout.write(json.dumps({
+                    'dispatcher': dispatcher,
+                    'kind': kind,
+                    'updates': len(updates),
+                    'microseconds_per_update': round(seconds / len(updates) * 10 ** 6, 3),
+                }, sort_keys=True))
@@ -0,0 +1,110 @@
+import json
+import random
+import time
+import tracemalloc
+from itertools import combinations
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from core.models import Company, Employee
+from core.pair_matcher import (
+    MaximumWeightGraphMatcher, GreedyMatcher, AutoMatcher, DefaultEstimator, DecayEstimator, LunchMap,
+    NEVER_MET_BONUS,
+)
+from core.synthetic import create_synthetic_company
+
+ENGINES = {
+    'blossom': MaximumWeightGraphMatcher,
+    'greedy': GreedyMatcher,
+    'auto': AutoMatcher,
+}
+
+ESTIMATORS = {
+    'default': DefaultEstimator,
+    'decay': DecayEstimator,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks pair matchers on synthetic companies with fake lunch history. '
+        'Prints one JSON object per run, all generated data is rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[50, 500, 2000, 10000])
+        parser.add_argument('--weeks', type=int, default=10, help='Weeks of lunch history to generate')
+        parser.add_argument('--engines', nargs='+', choices=list(ENGINES), default=list(ENGINES))
+        parser.add_argument('--estimators', nargs='+', choices=list(ESTIMATORS), default=list(ESTIMATORS))
+        parser.add_argument(
+            '--blossom-max-size', type=int, default=settings.PAIR_MATCHER_BLOSSOM_MAX_SIZE,
+            help='Bigger companies are not matched with blossom engine')
+        parser.add_argument('--seed', type=int)
+        parser.add_argument('-o', '--output', help='File to write results to instead of stdout')
+
+    def handle(self, *args, **options):
+        if options['seed'] is not None:
+            random.seed(options['seed'])
+            np.random.seed(options['seed'])
+
+        output = open(options['output'], 'w') if options['output'] else self.stdout
+        try:
+            for size in options['sizes']:
+                with transaction.atomic():
+                    company = create_synthetic_company(size, options['weeks'])
+                    for engine in options['engines']:
+                        if engine == 'blossom' and size > options['blossom_max_size']:
+                            continue
+                        for estimator in options['estimators']:
+                            result = self.run(company, ENGINES[engine], ESTIMATORS[estimator])
+                            result.update(size=size, weeks=options['weeks'], engine=engine, estimator=estimator)
+                            output.write(json.dumps(result, sort_keys=True) + '\n')
+                            output.flush()
+                    transaction.set_rollback(True)
+        finally:
+            if output is not self.stdout:
+                output.close()
+
+    @staticmethod
+    def run(company: Company, matcher_class, estimator_class) -> dict:
+        employees = list(Employee.objects.filter(company=company, state=Employee.State.online).select_related('user'))
+        matcher = matcher_class(estimator_class=estimator_class)
+
+        tracemalloc.start()
+        started_at = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            groups = matcher.match(company, employees)
+        seconds = time.perf_counter() - started_at
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # Quality is measured without random part of weights to be comparable between runs
+        lunch_map = LunchMap.for_company(company)
+        estimator = matcher.get_estimator(company, lunch_map)
+        today = timezone.localdate()
+        total_weight, pairs_count, repeat_count = 0.0, 0, 0
+        for group in groups:
+            for employee1, employee2 in combinations(group, 2):
+                pairs_count += 1
+                pair = lunch_map.get(employee1.pk, employee2.pk)
+                if pair is None:
+                    total_weight += NEVER_MET_BONUS
+                else:
+                    repeat_count += 1
+                    total_weight += float(estimator.get_met_bonus(
+                        np.float64((today - pair.last_date).days), np.float64(pair.times_met)))
+
+        return {
+            'seconds': round(seconds, 6),
+            'peak_memory': peak_memory,
+            'queries': len(queries),
+            'groups': len(groups),
+            'employees': sum(len(g) for g in groups),
+            'total_weight': round(total_weight, 6),
+            'repeat_rate': round(repeat_count / pairs_count, 6) if pairs_count else 0.0,
+        }
@@ -0,0 +1,38 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.telegram.updates import process_updates
+from lunchegram import bot
+
+# Seconds to wait after failed getUpdates request
+ERROR_DELAY = 5
+
+
+class Command(BaseCommand):
+    help = 'Runs the bot with getUpdates long polling instead of the webhook'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=100, help='Maximum number of updates in a batch')
+        parser.add_argument('--timeout', type=int, default=30, help='Seconds of long polling')
+
+    def handle(self, *args, **options):
+        # Telegram doesn't return updates while webhook is set, use `reset_webhooks` to set it back
+        bot.remove_webhook()
+        offset = None
+        while True:
+            try:
+                updates = bot.get_updates(offset=offset, limit=options['limit'], timeout=options['timeout'])
+            except Exception:
+                logging.exception('Could not get updates')
+                time.sleep(ERROR_DELAY)
+                continue
+            if not updates:
+                continue
+            # Offset is advanced anyway, otherwise a failing batch would be received again forever
+            offset = updates[-1].update_id + 1
+            try:
+                process_updates(updates)
+            except Exception:
+                logging.exception(f'Could not process updates {updates[0].update_id}-{updates[-1].update_id}')
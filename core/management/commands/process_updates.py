@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from core.telegram.updates import update_queue, process_raw_updates
+
+
+class Command(BaseCommand):
+    help = 'Processes Telegram updates queued by the webhook'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--timeout', type=int, default=5, help='Seconds to wait for updates at once')
+
+    def handle(self, *args, **options):
+        while True:
+            raw_updates = update_queue.pop_batch(options['batch_size'], options['timeout'])
+            if raw_updates:
+                process_raw_updates(raw_updates)
@@ -1,9 +1,124 @@
-from django.core.management.base import BaseCommand
+import random
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Sum, Count
+from django.utils import timezone
+from redis import Redis
+
+from core.models import Lunch, OutboxMessage, PipelineStage
+from core.synthetic import create_synthetic_company, delete_synthetic_companies
 from core.tasks import run_everything
+from core.telegram.stub import telegram_stub
+from lunchegram import celery_app
+from lunchegram.telebot import rate_limiter, DRY_RUN_RATE_LIMIT_PREFIX
+
+QUEUES = ['celery', 'matching']
+
+WORKERS_REPLY_TIMEOUT = 2
 
 
 class Command(BaseCommand):
     help = 'Run lunch generation right now'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Run the whole pipeline for synthetic companies against Telegram stub and report its timings')
+        parser.add_argument('--companies', type=int, default=10)
+        parser.add_argument('--employees', type=int, default=10000, help='Employees of all synthetic companies')
+        parser.add_argument('--weeks', type=int, default=10, help='Weeks of lunch history to generate')
+        parser.add_argument('--seed', type=int)
+        parser.add_argument(
+            '--eager', action='store_true',
+            help='Run tasks in this process, otherwise workers have to be started with TELEGRAM_DRY_RUN=on')
+        parser.add_argument('--timeout', type=float, default=60 * 60, help='Seconds to wait for workers')
+        parser.add_argument('--keep-data', action='store_true', help="Don't delete synthetic companies")
+
     def handle(self, *args, **options):
-        run_everything.delay()
+        if not options['dry_run']:
+            run_everything.delay()
+            return
+
+        real_messages = OutboxMessage.objects.pending().exclude(
+            lunch_group_member__lunch_group__lunch__company__is_synthetic=True)
+        if real_messages.exists():
+            # Outbox is sent by periodic task too, those messages would be lost in the stub
+            raise CommandError('Dry run would send pending outbox messages of real users to Telegram stub')
+        if options['eager']:
+            celery_app.conf.task_always_eager = True
+            telegram_stub.install()
+            rate_limiter.prefix = DRY_RUN_RATE_LIMIT_PREFIX
+        else:
+            self.check_workers()
+        if options['seed'] is not None:
+            random.seed(options['seed'])
+            np.random.seed(options['seed'])
+
+        try:
+            self.dry_run(options)
+        finally:
+            if not options['keep_data']:
+                delete_synthetic_companies()
+
+    @staticmethod
+    def check_workers():
+        """Makes sure that no worker sends messages to real users before anything is queued."""
+        if not settings.TELEGRAM_DRY_RUN:
+            raise CommandError('Celery workers and this command have to be started with TELEGRAM_DRY_RUN=on')
+        replies = celery_app.control.broadcast('telegram_dry_run', reply=True, timeout=WORKERS_REPLY_TIMEOUT)
+        if not replies:
+            raise CommandError('No Celery workers replied')
+        real_workers = [name for reply in replies for name, result in reply.items() if not result.get('ok')]
+        if real_workers:
+            raise CommandError(f'Workers {", ".join(real_workers)} were started without TELEGRAM_DRY_RUN=on')
+
+    def dry_run(self, options):
+        companies, employees = options['companies'], options['employees']
+        self.stdout.write(f'Creating {companies} synthetic companies with {employees} employees...')
+        sizes = [employees // companies + (i < employees % companies) for i in range(companies)]
+        company_ids = [create_synthetic_company(size, options['weeks'], with_telegram=True).pk for size in sizes]
+
+        started_at = time.monotonic()
+        run_id = run_everything.delay(dry_run=True, company_ids=company_ids).get()
+        peak_queue_depth = 0
+        if not options['eager']:
+            peak_queue_depth = self.wait(company_ids, started_at + options['timeout'])
+        seconds = time.monotonic() - started_at
+
+        today = timezone.localdate()
+        outbox = OutboxMessage.objects.filter(lunch_group_member__lunch_group__lunch__company_id__in=company_ids)
+        self.stdout.write(f'Finished in {seconds:.2f}s, peak queue depth {peak_queue_depth}')
+        self.stdout.write(
+            f'Lunches: {Lunch.objects.filter(company_id__in=company_ids, date=today).count()}/{companies}, '
+            f'messages sent: {outbox.filter(sent_at__isnull=False).count()}, '
+            f'pending: {outbox.pending().count()}, failed: {outbox.exclude(error="").count()}')
+
+        stages = PipelineStage.objects.filter(run_id=run_id).values('name').annotate(
+            count=Count('pk'), duration=Sum('duration'), queries=Sum('queries'),
+            telegram_calls=Sum('telegram_calls'), telegram_errors=Sum('telegram_errors'),
+        ).order_by('name')
+        for s in stages:
+            self.stdout.write(
+                f'{s["name"]}: {s["count"]} runs, {s["duration"]:.2f}s, {s["queries"]} queries, '
+                f'{s["telegram_calls"]} Telegram calls, {s["telegram_errors"]} errors')
+        if options['eager']:
+            self.stdout.write(f'Stub calls: {dict(telegram_stub.calls)}, errors: {dict(telegram_stub.errors)}')
+
+    def wait(self, company_ids, deadline) -> int:
+        """Waits until lunches are created and notifications are sent, returns peak number of queued tasks."""
+        broker = Redis.from_url(settings.CELERY_BROKER_URL)
+        today = timezone.localdate()
+        outbox = OutboxMessage.objects.filter(lunch_group_member__lunch_group__lunch__company_id__in=company_ids)
+        peak_queue_depth = 0
+        while time.monotonic() < deadline:
+            queue_depth = sum(broker.llen(queue) for queue in QUEUES)
+            peak_queue_depth = max(peak_queue_depth, queue_depth)
+            lunches = Lunch.objects.filter(company_id__in=company_ids, date=today).count()
+            if not queue_depth and lunches == len(company_ids) and not outbox.pending().exists():
+                return peak_queue_depth
+            time.sleep(1)
+        self.stderr.write('Timeout exceeded, pipeline has not finished')
+        return peak_queue_depth
@@ -20,12 +20,12 @@ class Command(BaseCommand):
         partner_user = User.objects.get(pk=test_user_id)
         employee = Employee.objects.get(user=test_user_id)
         message = __('Hello! Your next random lunch partner is here: [{}](tg://user?id={})\\(@{} [открыть на портале]({})\\)').format(
-            employee.get_full_name(), partner_user.telegram_account.uid, partner_user.username, employee.get_external_link())
+            employee.get_full_name(), partner_user.telegram_uid, partner_user.username, employee.get_external_link())
 
         html_message = __(
             'Hello! Your next random lunch partner is here: <a href="tg://user?id={}">{}</a> (@{} - <a href="{}">открыть на портале</a>)').format(
-            partner_user.telegram_account.uid, employee.get_full_name(), partner_user.username,
+            partner_user.telegram_uid, employee.get_full_name(), partner_user.username,
             employee.get_external_link())
 
         print(html_message)
-        bot.send_message(user.telegram_account.uid, html_message, parse_mode='HTML')
+        bot.send_message(user.telegram_uid, html_message, parse_mode='HTML')
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.9 on 2026-10-17 16:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_auto_20220903_0154'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='pair_decay_days',
+            field=models.PositiveSmallIntegerField(default=90, help_text='How many days it takes for employees who had lunch together to get their chances to meet back.', verbose_name='pair decay days'),
+        ),
+        migrations.AddField(
+            model_name='company',
+            name='repeat_pair_penalty',
+            field=models.FloatField(default=0.5, help_text='How much less likely employees are to meet again for every lunch they already had together.', verbose_name='repeat pair penalty'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 2.2.9 on 2026-10-17 19:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PipelineRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+            ],
+            options={
+                'verbose_name': 'pipeline run',
+                'verbose_name_plural': 'pipeline runs',
+            },
+        ),
+        migrations.CreateModel(
+            name='PipelineStage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('name', models.CharField(max_length=50)),
+                ('duration', models.FloatField(default=0)),
+                ('queries', models.PositiveIntegerField(default=0)),
+                ('rows_read', models.PositiveIntegerField(default=0)),
+                ('rows_written', models.PositiveIntegerField(default=0)),
+                ('telegram_calls', models.PositiveIntegerField(default=0)),
+                ('telegram_errors', models.PositiveIntegerField(default=0)),
+                ('company', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.Company')),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stages', to='core.PipelineRun')),
+            ],
+            options={
+                'verbose_name': 'pipeline stage',
+                'verbose_name_plural': 'pipeline stages',
+            },
+        ),
+    ]
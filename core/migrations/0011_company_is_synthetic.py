@@ -0,0 +1,18 @@
+# Generated by Django 2.2.9 on 2026-10-17 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_outboxmessage_claimed_until'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='is_synthetic',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
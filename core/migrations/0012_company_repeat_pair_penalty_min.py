@@ -0,0 +1,19 @@
+# Generated by Django 2.2.9 on 2026-10-17 23:10
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_company_is_synthetic'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='company',
+            name='repeat_pair_penalty',
+            field=models.FloatField(default=0.5, help_text='How much less likely employees are to meet again for every lunch they already had together.', validators=[django.core.validators.MinValueValidator(0)], verbose_name='repeat pair penalty'),
+        ),
+    ]
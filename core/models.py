@@ -2,7 +2,9 @@ import uuid
 from secrets import token_urlsafe
 
 from django.conf import settings
+from django.core.validators import MinValueValidator
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from djchoices import DjangoChoices, ChoiceItem
 from model_utils.managers import SoftDeletableManagerMixin, SoftDeletableQuerySetMixin
@@ -45,6 +47,14 @@ class Company(TimeStampedModel, SoftDeletableModel):
     employees = models.ManyToManyField(settings.AUTH_USER_MODEL, through='core.Employee', related_name='companies')
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT, related_name='owned_companies')
     lunches_enabled = models.BooleanField(_('lunches enabled'), default=True)
+    # Created by benchmarks and dry runs, see `core.synthetic`
+    is_synthetic = models.BooleanField(default=False, editable=False)
+    pair_decay_days = models.PositiveSmallIntegerField(
+        _('pair decay days'), default=90,
+        help_text=_('How many days it takes for employees who had lunch together to get their chances to meet back.'))
+    repeat_pair_penalty = models.FloatField(
+        _('repeat pair penalty'), default=0.5, validators=[MinValueValidator(0)],
+        help_text=_('How much less likely employees are to meet again for every lunch they already had together.'))
 
     objects = CompanyManager()
 
@@ -139,6 +149,59 @@ class LunchGroupMember(TimeStampedModel):
         return self.notified_at is not None
 
 
+class OutboxMessageQuerySet(models.QuerySet):
+    def pending(self):
+        return self.filter(sent_at__isnull=True, error='')
+
+    def claimable(self):
+        """Pending messages which aren't being sent by another sender."""
+        return self.pending().filter(models.Q(claimed_until__isnull=True) | models.Q(claimed_until__lt=timezone.now()))
+
+
+class OutboxMessage(TimeStampedModel):
+    """Telegram message saved in the same transaction as its cause and sent later by `core.tasks.send_outbox`"""
+    chat_id = models.CharField(max_length=255)
+    text = models.TextField()
+    parse_mode = models.CharField(max_length=10, blank=True)
+    lunch_group_member = models.OneToOneField(
+        LunchGroupMember, on_delete=models.CASCADE, blank=True, null=True, related_name='outbox_message')
+    sent_at = models.DateTimeField(blank=True, null=True)
+    message_id = models.PositiveIntegerField(blank=True, null=True)
+    error = models.TextField(blank=True)
+    # Sender claims messages for a while, so that they are sent outside of transactions
+    claimed_until = models.DateTimeField(blank=True, null=True)
+
+    objects = OutboxMessageQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'outbox message'
+        verbose_name_plural = 'outbox messages'
+
+
+class PipelineRun(TimeStampedModel):
+    """Summary of a weekly lunch pipeline run, see `core.instrumentation`"""
+
+    class Meta:
+        verbose_name = 'pipeline run'
+        verbose_name_plural = 'pipeline runs'
+
+
+class PipelineStage(TimeStampedModel):
+    run = models.ForeignKey(PipelineRun, on_delete=models.CASCADE, related_name='stages')
+    name = models.CharField(max_length=50)
+    company = models.ForeignKey(Company, on_delete=models.SET_NULL, blank=True, null=True)
+    duration = models.FloatField(default=0)
+    queries = models.PositiveIntegerField(default=0)
+    rows_read = models.PositiveIntegerField(default=0)
+    rows_written = models.PositiveIntegerField(default=0)
+    telegram_calls = models.PositiveIntegerField(default=0)
+    telegram_errors = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = 'pipeline stage'
+        verbose_name_plural = 'pipeline stages'
+
+
 class TelegramChat(TimeStampedModel):
     """Stores every chat with the bot (for possible future use)"""
     chat_id = models.CharField(max_length=255, unique=True)
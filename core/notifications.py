@@ -0,0 +1,47 @@
+from collections import defaultdict
+from typing import Dict, Iterable, Optional, Tuple
+
+from django.utils.translation import gettext as __
+
+from core.models import LunchGroup, LunchGroupMember
+
+
+def get_partner_link_html(employee, uid: Optional[str]) -> str:
+    # Partners without Telegram accounts can't be mentioned, their names are plain text
+    name_html = f'<a href="tg://user?id={uid}">{employee.get_full_name()}</a>' if uid else employee.get_full_name()
+    return (
+        f'{name_html} '
+        f'(@{employee.user.username} - <a href="{employee.get_external_link()}">открыть на портале</a>)'
+    )
+
+
+def render_notifications(member_ids: Iterable[int]) -> Dict[int, Tuple[str, str]]:
+    """
+    Returns member id → (Telegram uid, HTML message) for members who have to be notified about their lunch partners.
+    Members, partners, their users and companies are loaded with a single query.
+    """
+    member_ids = set(member_ids)
+    members = list(
+        LunchGroupMember.objects
+        .filter(lunch_group__in=LunchGroup.objects.filter(members__pk__in=list(member_ids)))
+        .select_related('employee__user', 'employee__company')
+    )
+    uids = {m.employee.user_id: m.employee.user.telegram_uid for m in members if m.employee.user.telegram_uid}
+
+    groups = defaultdict(list)
+    for member in members:
+        groups[member.lunch_group_id].append(member)
+
+    notifications = {}
+    for member in members:
+        if member.pk not in member_ids or member.is_notified or member.employee.user_id not in uids:
+            continue
+        partners = [p.employee for p in groups[member.lunch_group_id] if p.pk != member.pk]
+        if len(partners) == 1:
+            partner_link_html = get_partner_link_html(partners[0], uids.get(partners[0].user_id))
+            message_html = __('Hello! Your next random lunch partner is here: {}').format(partner_link_html)
+        else:
+            partner_links_html = (get_partner_link_html(p, uids.get(p.user_id)) for p in partners)
+            message_html = __('Hello! Your next random lunch partners are here: {}').format(', '.join(partner_links_html))
+        notifications[member.pk] = (uids[member.employee.user_id], message_html)
+    return notifications
@@ -1,21 +1,112 @@
+import logging
+import time
+from collections import defaultdict
+from datetime import date
 from itertools import combinations
-from random import random, choice
-from typing import Set, List, FrozenSet
+from random import random, choice, seed
+from typing import Set, List, FrozenSet, Dict, Optional, Sequence, Tuple
 
 import attr
+import billiard
 import networkx as nx
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
 
-from core.models import Employee, LunchGroupMember, Company, LunchGroup
+from core.models import Employee, LunchGroupMember, Company
+
+
+NEVER_MET_BONUS = 2
+
+# Rows of weight matrix processed at once, so that temporary arrays stay small for big companies
+BLOCK_SIZE = 256
+
+
+@attr.s(slots=True)
+class LunchMapPair:
+    last_date = attr.ib(type=date)
+    times_met = attr.ib(type=int, default=0)
 
 
 @attr.s(slots=True)
-class LunchMapEmployee:
-    employee = attr.ib(type=Employee)
+class LunchMapHistory:
+    """Pairing history of selected employees as parallel arrays, one item per pair which had lunch together."""
+    rows = attr.ib(type=np.ndarray)
+    cols = attr.ib(type=np.ndarray)
+    days_since = attr.ib(type=np.ndarray)
+    times_met = attr.ib(type=np.ndarray)
+
+
+class LunchMap:
+    """
+    In-memory index of company's pairing history: pair of employee ids → last lunch date and number of meetings.
+    """
+    def __init__(self, pairs: Dict[FrozenSet, LunchMapPair] = None):
+        self.pairs = pairs or {}
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def get(self, employee1_id, employee2_id) -> Optional[LunchMapPair]:
+        return self.pairs.get(frozenset((employee1_id, employee2_id)))
+
+    def add(self, employee1_id, employee2_id, lunch_date: date):
+        key = frozenset((employee1_id, employee2_id))
+        pair = self.pairs.get(key)
+        if pair is None:
+            pair = self.pairs[key] = LunchMapPair(last_date=lunch_date)
+        elif lunch_date > pair.last_date:
+            pair.last_date = lunch_date
+        pair.times_met += 1
+
+    def get_history(self, employee_ids: Sequence, today: date = None) -> LunchMapHistory:
+        """
+        Returns history of pairs among given employees.
+        Row and column values are positions of employees in `employee_ids`.
+        """
+        today = today or timezone.localdate()
+        index = {employee_id: i for i, employee_id in enumerate(employee_ids)}
+        rows, cols, days_since, times_met = [], [], [], []
+        for key, pair in self.pairs.items():
+            employee1_id, employee2_id = key
+            if employee1_id in index and employee2_id in index:
+                rows.append(index[employee1_id])
+                cols.append(index[employee2_id])
+                days_since.append((today - pair.last_date).days)
+                times_met.append(pair.times_met)
+        return LunchMapHistory(
+            rows=np.array(rows, dtype=np.intp),
+            cols=np.array(cols, dtype=np.intp),
+            days_since=np.array(days_since, dtype=np.float64),
+            times_met=np.array(times_met, dtype=np.float64),
+        )
+
+    @classmethod
+    def for_company(cls, company: Company) -> 'LunchMap':
+        """Loads whole pairing history of the company with a single query."""
+        rows = LunchGroupMember.objects.filter(lunch_group__lunch__company=company).values_list(
+            'lunch_group_id', 'employee_id', 'lunch_group__lunch__date')
+
+        groups = defaultdict(list)
+        dates = {}
+        for lunch_group_id, employee_id, lunch_date in rows.iterator():
+            groups[lunch_group_id].append(employee_id)
+            dates[lunch_group_id] = lunch_date
+
+        lunch_map = cls()
+        for lunch_group_id, employee_ids in groups.items():
+            for employee1_id, employee2_id in combinations(employee_ids, 2):
+                lunch_map.add(employee1_id, employee2_id, dates[lunch_group_id])
+        return lunch_map
 
 
 class DefaultEstimator:
-    def __init__(self, lunch_map=None):
-        self.lunch_map = lunch_map
+    def __init__(self, lunch_map: LunchMap = None):
+        self.lunch_map = lunch_map if lunch_map is not None else LunchMap()
+
+    @classmethod
+    def for_company(cls, company: Company, lunch_map: LunchMap = None) -> 'DefaultEstimator':
+        return cls(lunch_map)
 
     def get_weight(self, employee1: Employee, employee2: Employee) -> float:
         """
@@ -25,72 +116,141 @@ class DefaultEstimator:
         """
         weight = random()
 
-        members = LunchGroupMember.objects.filter(
-            employee=employee1, lunch_group__employees=employee2).select_related('lunch').order_by('-lunch__date')
-        if members.exists():
-            # Apply decay so employees from lunches further away have better chances to meet again if
-            # there are no fresh employees
-            # TODO: make actual decaying weight
-            # weight += exp(-8*x*x)
-            pass
+        pair = self.lunch_map.get(employee1.pk, employee2.pk)
+        if pair is not None:
+            days_since = (timezone.localdate() - pair.last_date).days
+            weight += float(self.get_met_bonus(np.float64(days_since), np.float64(pair.times_met)))
         else:
             # Never had lunch together bonus
-            weight += 2
+            weight += NEVER_MET_BONUS
 
         return weight
 
+    def get_met_bonus(self, days_since: np.ndarray, times_met: np.ndarray) -> np.ndarray:
+        """
+        Returns bonus for pairs which already had lunch together.
+        Works element-wise on arrays of days since last lunch and number of lunches together.
+        """
+        return np.zeros_like(days_since)
 
-@attr.s(cmp=False, slots=True)
-class Node:
-    employee = attr.ib(type=Employee)
+    def get_weight_matrix(self, employee_ids: Sequence) -> np.ndarray:
+        """
+        Returns symmetric float32 matrix of weights between all given employees, same as `get_weight` for every pair.
+        Diagonal is zero. Matrix is filled in place, so memory of a single matrix is used.
+        """
+        size = len(employee_ids)
+        weights = np.empty((size, size), dtype=np.float32)
+        for start in range(0, size, BLOCK_SIZE):
+            weights[start:start + BLOCK_SIZE] = np.random.random((len(weights[start:start + BLOCK_SIZE]), size))
+        weights += NEVER_MET_BONUS
+
+        history = self.lunch_map.get_history(employee_ids)
+        met_weights = np.random.random(len(history.rows)) + self.get_met_bonus(history.days_since, history.times_met)
+        weights[history.rows, history.cols] = met_weights
+        weights[history.cols, history.rows] = met_weights
+
+        # Mirror upper triangle to the lower one
+        for start in range(0, size, BLOCK_SIZE):
+            stop = min(start + BLOCK_SIZE, size)
+            weights[start:stop, :start] = weights[:start, start:stop].T
+            block = weights[start:stop, start:stop]
+            block[...] = np.triu(block, 1) + np.triu(block, 1).T
+        return weights
+
+
+class DecayEstimator(DefaultEstimator):
+    """
+    Employees from lunches further away have better chances to meet again if there are no fresh employees.
 
-    def __hash__(self):
-        return id(self)
+    Bonus of a pair grows back to the never met bonus as days since their last lunch pass
+    and is divided by a penalty for every repeated lunch.
+    """
+    def __init__(self, lunch_map: LunchMap = None, decay_days: float = 90, repeat_penalty: float = 0.5):
+        super().__init__(lunch_map)
+        self.decay_days = decay_days
+        self.repeat_penalty = repeat_penalty
 
-    def __eq__(self, other):
-        return hash(self) == hash(other)
+    @classmethod
+    def for_company(cls, company: Company, lunch_map: LunchMap = None) -> 'DecayEstimator':
+        # Negative penalty would make weights infinite or negative, companies saved before validation may have it
+        repeat_penalty = max(company.repeat_pair_penalty, 0)
+        return cls(lunch_map, decay_days=company.pair_decay_days, repeat_penalty=repeat_penalty)
+
+    def get_met_bonus(self, days_since: np.ndarray, times_met: np.ndarray) -> np.ndarray:
+        recovery = 1 - np.exp(-np.maximum(days_since, 0) / max(self.decay_days, 1))
+        return NEVER_MET_BONUS * recovery / (1 + self.repeat_penalty * np.maximum(times_met - 1, 0))
+
+
+def get_sparse_edges(weights: np.ndarray, k: int, random_count: int = 0):
+    """
+    Returns upper triangle edges (rows, cols) which connect every node with `k` partners of the best weight
+    and `random_count` random partners.
+    Partners are selected for a block of rows at once, so the whole matrix is never sorted.
+    """
+    size = len(weights)
+    k = min(k, size - 1)
+    candidates = np.empty((size, k), dtype=np.intp)
+    for start in range(0, size, BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, size)
+        scores = np.negative(weights[start:stop])
+        scores[np.arange(stop - start), np.arange(start, stop)] = np.inf
+        candidates[start:stop] = np.argpartition(scores, k - 1, axis=1)[:, :k]
+    if random_count:
+        candidates = np.hstack([candidates, np.random.randint(0, size, (size, random_count))])
+
+    rows = np.repeat(np.arange(size), candidates.shape[1])
+    cols = candidates.ravel()
+    rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+    edges = np.unique(rows * size + cols)
+    rows, cols = np.divmod(edges, size)
+    mask = rows != cols
+    return rows[mask], cols[mask]
 
 
 @attr.s
-class MaximumWeightGraphMatcher:
-    estimator_class = attr.ib(default=DefaultEstimator)
+class BaseMatcher:
+    estimator_class = attr.ib(default=DecayEstimator)
+
+    def make_lunch_map(self, company: Company) -> LunchMap:
+        return LunchMap.for_company(company)
 
-    def make_lunch_map(self, company: Company):
-        LunchGroup.objects.filter(company=company)
+    def get_estimator(self, company: Company, lunch_map: LunchMap = None):
+        return self.estimator_class.for_company(company, lunch_map)
 
-    def get_estimator(self):
-        return self.estimator_class()
+    def get_weight_matrix(self, company: Company, employees: List[Employee]) -> np.ndarray:
+        estimator = self.get_estimator(company, self.make_lunch_map(company))
+        return estimator.get_weight_matrix([e.pk for e in employees])
 
-    def match(self, company: Company, employees: List[Employee]) -> Set[FrozenSet[Employee]]:
+    def match(
+            self, company: Company, employees: List[Employee], weights: np.ndarray = None,
+    ) -> Set[FrozenSet[Employee]]:
         """
-        Blossom graph matching algorithm.
-        If number of users is odd we have to add copy of one of users to make a group of three.
+        Precomputed `weights` matrix may be passed, it has to be ordered the same way as `employees`.
         """
-        graph = nx.Graph()
-        estimator = self.get_estimator()
-
-        # Select lucky employee to be part of a group of 3 if needed
         employees = list(employees)
-        if len(employees) % 2:
-            lucky_employee = choice(employees)
-            employees.append(lucky_employee)
+        if weights is None:
+            weights = self.get_weight_matrix(company, employees)
+        return {frozenset(employees[i] for i in group) for group in self.match_positions(company, weights)}
 
-        # Fill the graph
-        nodes = [Node(e) for e in employees]
-        graph.add_nodes_from(nodes)
-        for node1, node2 in combinations(nodes, 2):
-            if node1.employee == node2.employee:
-                continue
-            weight = estimator.get_weight(node1.employee, node2.employee)
-            graph.add_weighted_edges_from([(node1, node2, weight)])
+    def match_positions(self, company: Company, weights: np.ndarray) -> Set[FrozenSet[int]]:
+        """
+        Returns groups of employee positions in `weights` matrix.
+        If number of users is odd we have to add copy of one of users to make a group of three.
+        """
+        # Select lucky employee to be part of a group of 3 if needed
+        positions = np.arange(len(weights))
+        if len(positions) % 2:
+            positions = np.append(positions, choice(positions))
+            weights = weights[np.ix_(positions, positions)]
+        nodes = list(range(len(positions)))
 
-        # Run matching algorithm
-        matching = nx.max_weight_matching(graph)
+        matching = self.find_matching(company, nodes, positions, weights)
 
         # Find group of three if any
+        position_list = positions.tolist()
         group_map = {}
         for n1, n2 in matching:
-            e1, e2 = n1.employee, n2.employee
+            e1, e2 = position_list[n1], position_list[n2]
             if e2 in group_map:
                 e1, e2 = e2, e1
             if e1 in group_map:
@@ -104,3 +264,206 @@ class MaximumWeightGraphMatcher:
             groups.add(frozenset(group))
 
         return groups
+
+    def find_matching(self, company: Company, nodes: list, positions: np.ndarray, weights: np.ndarray) -> set:
+        """
+        Returns set of matched pairs of nodes.
+        Nodes with equal positions are copies of the same employee and must not be matched together.
+        """
+        raise NotImplementedError
+
+
+@attr.s
+class MaximumWeightGraphMatcher(BaseMatcher):
+    """
+    Blossom graph matching algorithm.
+
+    Sparse mode is used for companies with at least `sparse_threshold` employees:
+    matching runs on a graph of `sparse_k` best and `sparse_random` random partners of every employee.
+    If such graph has no perfect matching, complete graph is used.
+    """
+    sparse_threshold = attr.ib(factory=lambda: settings.PAIR_MATCHER_SPARSE_THRESHOLD)
+    sparse_k = attr.ib(factory=lambda: settings.PAIR_MATCHER_SPARSE_K)
+    sparse_random = attr.ib(factory=lambda: settings.PAIR_MATCHER_SPARSE_RANDOM)
+
+    def is_sparse(self, size: int) -> bool:
+        return self.sparse_threshold is not None and size >= self.sparse_threshold
+
+    def find_matching(self, company, nodes, positions, weights):
+        if self.is_sparse(len(nodes)):
+            rows, cols = get_sparse_edges(weights, self.sparse_k, self.sparse_random)
+            matching = self._run_matching(nodes, positions, weights, rows, cols, maxcardinality=True)
+            if len(matching) * 2 == len(nodes):
+                return matching
+            logging.info(f'Sparse graph of company `{company}` has no perfect matching, using complete graph')
+
+        rows, cols = np.triu_indices(len(nodes), 1)
+        return self._run_matching(nodes, positions, weights, rows, cols)
+
+    @staticmethod
+    def _run_matching(nodes, positions, weights, rows, cols, maxcardinality=False):
+        # Fill the graph, there is no edge between lucky employee and his copy
+        mask = positions[rows] != positions[cols]
+        rows, cols = rows[mask], cols[mask]
+        graph = nx.Graph()
+        graph.add_nodes_from(nodes)
+        graph.add_weighted_edges_from(zip(
+            (nodes[i] for i in rows), (nodes[j] for j in cols), weights[rows, cols].tolist()))
+
+        # Run matching algorithm
+        return nx.max_weight_matching(graph, maxcardinality=maxcardinality)
+
+
+@attr.s
+class GreedyMatcher(BaseMatcher):
+    """
+    Takes edges in order of decreasing weight while both of their nodes are free,
+    then improves matching by swapping partners between pairs while it increases total weight.
+
+    Companies with at least `sparse_threshold` employees take edges only from `sparse_k` best partners
+    of every employee.
+    """
+    sparse_threshold = attr.ib(factory=lambda: settings.PAIR_MATCHER_SPARSE_THRESHOLD)
+    sparse_k = attr.ib(factory=lambda: settings.PAIR_MATCHER_SPARSE_K)
+    improvement_passes = attr.ib(default=10)
+
+    def find_matching(self, company, nodes, positions, weights):
+        # Copies of the same employee are excluded by their positions, weights aren't copied
+        size = len(nodes)
+        if self.sparse_threshold is not None and size >= self.sparse_threshold:
+            rows, cols = get_sparse_edges(weights, self.sparse_k)
+        else:
+            rows, cols = np.triu_indices(size, 1)
+        mask = positions[rows] != positions[cols]
+        rows, cols = rows[mask], cols[mask]
+        order = np.argsort(-weights[rows, cols], kind='stable')
+
+        mates = [-1] * size
+        for i, j in zip(rows[order].tolist(), cols[order].tolist()):
+            if mates[i] < 0 and mates[j] < 0:
+                mates[i], mates[j] = j, i
+
+        # Pair nodes left after sparse edges
+        free = [i for i in range(size) if mates[i] < 0]
+        while free:
+            i = free.pop()
+            partners = [j for j in free if positions[j] != positions[i]]
+            if partners:
+                j = max(partners, key=lambda j: weights[i, j])
+                free.remove(j)
+                mates[i], mates[j] = j, i
+            else:
+                j = free.pop()
+                # Only copy of the same employee is left, break up any other pair
+                other = next((k for k in range(size) if mates[k] >= 0), None)
+                if other is None:
+                    # Single employee has nobody to have lunch with
+                    continue
+                other_mate = mates[other]
+                mates[i], mates[other] = other, i
+                mates[j], mates[other_mate] = other_mate, j
+
+        first = np.array([i for i in range(size) if i < mates[i]], dtype=np.intp)
+        second = np.array([mates[i] for i in first], dtype=np.intp)
+        self._improve(weights, positions, first, second)
+
+        return {(nodes[i], nodes[j]) for i, j in zip(first.tolist(), second.tolist())}
+
+    def _improve(self, weights: np.ndarray, positions: np.ndarray, first: np.ndarray, second: np.ndarray):
+        """Swaps partners between two pairs in place while it increases total weight."""
+        current = weights[first, second].astype(np.float64)
+        first_positions, second_positions = positions[first], positions[second]
+        for _ in range(self.improvement_passes):
+            improved = False
+            for x in range(len(first)):
+                a, b = first[x], second[x]
+                total = current[x] + current
+                gains = (
+                    weights[a, first] + weights[b, second] - total,
+                    weights[a, second] + weights[b, first] - total,
+                )
+                # Copies of the same employee must not become partners
+                gains[0][(first_positions == positions[a]) | (second_positions == positions[b])] = -np.inf
+                gains[1][(second_positions == positions[a]) | (first_positions == positions[b])] = -np.inf
+                swap = int(gains[1].max() > gains[0].max())
+                y = int(gains[swap].argmax())
+                if gains[swap][y] <= 1e-9:
+                    continue
+                c, d = first[y], second[y]
+                if swap:
+                    c, d = d, c
+                first[x], second[x], first[y], second[y] = a, c, b, d
+                first_positions[[x, y]], second_positions[[x, y]] = positions[[a, b]], positions[[c, d]]
+                current[x], current[y] = weights[a, c], weights[b, d]
+                improved = True
+            if not improved:
+                break
+
+
+def _run_matcher_process(conn, matcher: BaseMatcher, positions: np.ndarray, weights: np.ndarray):
+    matching = matcher.find_matching(None, list(range(len(positions))), positions, weights)
+    conn.send(matching)
+    conn.close()
+
+
+@attr.s
+class AutoMatcher(BaseMatcher):
+    """
+    Uses blossom algorithm for companies up to `blossom_max_size` employees and greedy matching for bigger ones.
+
+    Greedy matching is always computed first. Blossom runs in a separate process and is terminated
+    if it doesn't finish within `time_budget` seconds, greedy matching is returned then.
+    """
+    blossom_max_size = attr.ib(factory=lambda: settings.PAIR_MATCHER_BLOSSOM_MAX_SIZE)
+    time_budget = attr.ib(factory=lambda: settings.PAIR_MATCHER_TIME_BUDGET)
+    blossom_matcher = attr.ib(factory=MaximumWeightGraphMatcher)
+    greedy_matcher = attr.ib(factory=GreedyMatcher)
+
+    def find_matching(self, company, nodes, positions, weights):
+        started_at = time.monotonic()
+        greedy_matching = self.greedy_matcher.find_matching(company, nodes, positions, weights)
+        if len(nodes) > self.blossom_max_size:
+            return greedy_matching
+
+        index_matching = self._run_blossom(positions, weights, self.time_budget - (time.monotonic() - started_at))
+        if index_matching is None:
+            logging.warning(f'Blossom matching of company `{company}` exceeded time budget, using greedy matching')
+            return greedy_matching
+        return {(nodes[i], nodes[j]) for i, j in index_matching}
+
+    def _run_blossom(self, positions, weights, timeout):
+        if timeout <= 0:
+            return None
+        # billiard allows to start processes from daemonic Celery workers
+        parent_conn, child_conn = billiard.Pipe(duplex=False)
+        process = billiard.Process(
+            target=_run_matcher_process, args=(child_conn, self.blossom_matcher, positions, weights), daemon=True)
+        process.start()
+        child_conn.close()
+        try:
+            if parent_conn.poll(timeout):
+                return parent_conn.recv()
+            return None
+        finally:
+            parent_conn.close()
+            process.terminate()
+            process.join()
+
+
+def init_matching_process():
+    """Pool initializer, forked processes have to get their own random state."""
+    seed()
+    np.random.seed()
+
+
+def match_company(
+        matcher: BaseMatcher, company: Company, estimator: DefaultEstimator, employee_ids: Sequence,
+) -> Tuple[Set[FrozenSet[int]], float]:
+    """
+    Returns groups of positions in `employee_ids` and seconds it took to match them.
+    Doesn't touch the database, so it can run in a process pool.
+    """
+    started_at = time.monotonic()
+    weights = estimator.get_weight_matrix(employee_ids)
+    groups = matcher.match_positions(company, weights)
+    return groups, time.monotonic() - started_at
@@ -0,0 +1,85 @@
+import time
+from typing import Optional
+
+from redis import Redis
+from telebot.apihelper import ApiException
+
+# Every key is a token bucket with rate and capacity given in ARGV after current time.
+# Tokens are taken from all buckets at once or from none of them, returns seconds to wait otherwise.
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local capacity = tonumber(ARGV[i * 2 + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    available = math.min(capacity, available + math.max(now - ts, 0) * rate)
+    tokens[i] = available
+    if available < 1 then
+        wait = math.max(wait, (1 - available) / rate)
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local capacity = tonumber(ARGV[i * 2 + 1])
+    redis.call('HMSET', key, 'tokens', tokens[i] - 1, 'ts', now)
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+end
+return '0'
+"""
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+class RateLimiter:
+    """
+    Global and per chat token buckets stored in Redis, so they are shared by all processes.
+    """
+    def __init__(
+            self, redis: Redis, global_rate: float = 30, chat_rate: float = 1, chat_capacity: float = 1,
+            prefix: str = 'ratelimit',
+    ):
+        self.redis = redis
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_capacity = chat_capacity
+        self.prefix = prefix
+        self._script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def try_acquire(self, chat_id=None) -> float:
+        """Takes a token for the chat, returns 0 on success or seconds to wait before the next try."""
+        keys = [f'{self.prefix}:global']
+        args = [time.time(), self.global_rate, self.global_rate]
+        if chat_id is not None:
+            keys.append(f'{self.prefix}:chat:{chat_id}')
+            args += [self.chat_rate, self.chat_capacity]
+        return float(self._script(keys=keys, args=args))
+
+    def acquire(self, chat_id=None, timeout: Optional[float] = None):
+        """Waits until a token for the chat is taken."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire(chat_id)
+            if not wait:
+                return
+            if deadline is not None and time.monotonic() + wait > deadline:
+                raise RateLimitTimeout(f'Could not send message to chat `{chat_id}` in {timeout}s')
+            time.sleep(wait)
+
+
+def get_retry_after(e: ApiException) -> Optional[int]:
+    """Returns seconds Telegram asked to wait if request was rejected with 429 Too Many Requests."""
+    if e.result.status_code != 429:
+        return None
+    try:
+        return int(e.result.json()['parameters']['retry_after'])
+    except (ValueError, KeyError, TypeError):
+        return 1
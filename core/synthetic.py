@@ -0,0 +1,62 @@
+"""Synthetic companies with fake lunch history for benchmarks and dry runs."""
+import uuid
+from datetime import timedelta
+
+import numpy as np
+from django.utils import timezone
+from social_django.models import UserSocialAuth
+
+from accounts.models import User
+from core.models import Company, Employee, Lunch, LunchGroup, LunchGroupMember
+
+SYNTHETIC_PREFIX = 'synthetic-'
+
+
+def create_synthetic_company(size: int, weeks: int, with_telegram: bool = False) -> Company:
+    """
+    Creates company of `size` employees who had lunches in random pairs every week for `weeks` weeks.
+    Users get fake Telegram accounts if `with_telegram` is set, their uids are never valid Telegram chats.
+    """
+    prefix = f'{SYNTHETIC_PREFIX}{uuid.uuid4().hex[:8]}-'
+    User.objects.bulk_create(User(username=f'{prefix}{i}', has_telegram=True) for i in range(size + 1))
+    users = list(User.objects.filter(username__startswith=prefix).order_by('pk'))
+    if with_telegram:
+        for user in users:
+            user.telegram_uid = f'{SYNTHETIC_PREFIX}{user.pk}'
+        User.objects.bulk_update(users, ['telegram_uid'])
+        UserSocialAuth.objects.bulk_create(
+            UserSocialAuth(user=user, provider='telegram', uid=user.telegram_uid, extra_data={}) for user in users)
+    company = Company.objects.create(
+        name=prefix.strip('-'), privacy_mode=Company.Privacy.link, owner=users.pop(), is_synthetic=True)
+    employees = [Employee(company=company, user=user) for user in users]
+    Employee.objects.bulk_create(employees)
+
+    today = timezone.localdate()
+    for week in range(weeks, 0, -1):
+        lunch = Lunch.objects.create(company=company, date=today - timedelta(weeks=week))
+        order = np.random.permutation(size).tolist()
+        groups = [order[i:i + 2] for i in range(0, size - 1, 2)]
+        if size % 2 and groups:
+            groups[-1].append(order[-1])
+
+        LunchGroup.objects.bulk_create(LunchGroup(lunch=lunch) for _ in groups)
+        group_ids = LunchGroup.objects.filter(lunch=lunch).values_list('pk', flat=True)
+        LunchGroupMember.objects.bulk_create(
+            LunchGroupMember(lunch_group_id=group_id, employee=employees[i])
+            for group_id, group in zip(group_ids, groups) for i in group
+        )
+    return company
+
+
+def delete_synthetic_companies():
+    """Deletes all synthetic companies with their users, users of real companies are kept."""
+    companies = Company.objects.filter(is_synthetic=True)
+    user_ids = set(Employee.objects.filter(company__in=companies).values_list('user_id', flat=True))
+    user_ids.update(companies.values_list('owner_id', flat=True))
+    real_user_ids = set(Employee.objects.filter(
+        user_id__in=user_ids, company__is_synthetic=False).values_list('user_id', flat=True))
+    real_user_ids.update(Company.objects.filter(
+        owner_id__in=user_ids, is_synthetic=False).values_list('owner_id', flat=True))
+    for company in companies:
+        company.delete(soft=False)
+    User.objects.filter(pk__in=user_ids - real_user_ids).delete()
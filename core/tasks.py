@@ -1,120 +1,270 @@
 import logging
+from datetime import timedelta
+from typing import List, Optional
 
+import billiard
 import celery
+from django.conf import settings
 from django.db import transaction
 from django.utils import timezone
-from django.utils.translation import gettext as __
+from redis import RedisError
 from telebot.apihelper import ApiException
 
 from accounts.models import User
-from core.models import Company, Employee, LunchGroup, Lunch, LunchGroupMember
-from core.pair_matcher import MaximumWeightGraphMatcher
+from core.instrumentation import stage, record_stage
+from core.models import Company, Employee, LunchGroup, Lunch, LunchGroupMember, OutboxMessage, PipelineRun
+from core.notifications import render_notifications
+from core.pair_matcher import AutoMatcher, match_company, init_matching_process
+from core.rate_limiter import get_retry_after
+from core.telegram.liveness import liveness_registry
+from core.telegram.memberships import membership_cache
 from lunchegram import celery_app, bot
 from core.utils import kokoc_users_sync
 
+# Messages rejected by Telegram rate limits are sent again after `retry_after` seconds
+TELEGRAM_MAX_RETRIES = 10
 
-@celery_app.task
-def run_everything():
-    kokoc_users_sync()
-    create_lunch_groups.delay()
+# Seconds to wait before sending outbox messages again after unexpected errors
+OUTBOX_RETRY_DELAY = 60
+
+# Seconds a batch of outbox messages is claimed by its sender, messages of a crashed sender are sent after that
+OUTBOX_CLAIM_TIMEOUT = 10 * 60
 
 
 @celery_app.task
-def create_lunch_groups():
-    for company in Company.objects.lunches_enabled():
-        employees = Employee.objects.filter(company=company, state=Employee.State.online)
-        check_employee_tasks = [check_employee_in_telegram.si(pk) for pk in employees.values_list('pk', flat=True)]
-        job = celery.group(check_employee_tasks) | create_lunch_groups_for_company.si(company.pk)
-        job.apply_async()
+def run_everything(dry_run=False, company_ids=None):
+    """
+    Dry run doesn't sync users with external service, it's meant to be used with Telegram stub.
+    Returns id of the pipeline run.
+    """
+    run = PipelineRun.objects.create()
+    if not dry_run:
+        with stage('kokoc_users_sync', run.pk):
+            kokoc_users_sync()
+    create_lunch_groups.delay(run.pk, company_ids)
+    return run.pk
 
 
 @celery_app.task
-def check_employee_in_telegram(employee_id):
-    employee = Employee.objects.select_related('user').get(pk=employee_id)
-    if employee.user.telegram_account is None:
-        employee.state = Employee.State.offline
-        employee.save()
-        return
-    try:
-        bot.send_message(
-            employee.user.telegram_account.uid,
-            __("We have started to look for a perfect lunch partner for you! "
-               "Soon you will get link to your partner's account.\n\n"
-               "_You received this message because we make sure all participants still available._"),
-            parse_mode='Markdown',
-        )
-    except ApiException as e:
-        if e.result.status_code == 403 and b'bot was blocked by the user' in e.result.content:
-            employee.state = Employee.State.offline
-            employee.save()
-            logging.info(f'User `{employee.user}` as employee of company `{employee.company} was switched offline`')
+def create_lunch_groups(run_id=None, company_ids=None):
+    """Synthetic companies get lunches only when they are given explicitly, e.g. by dry runs."""
+    with stage('create_lunch_groups', run_id):
+        companies = Company.objects.lunches_enabled()
+        if company_ids is not None:
+            companies = companies.filter(pk__in=company_ids)
+        else:
+            companies = companies.filter(is_synthetic=False)
+        company_ids = list(companies.values_list('pk', flat=True))
+        employees = Employee.objects.filter(company_id__in=company_ids, state=Employee.State.online)
+        stale_ids = get_stale_employee_ids(employees)
+        chunk_size = settings.TELEGRAM_PROBE_CHUNK_SIZE
+        check_employee_tasks = [
+            check_employees_in_telegram.si(stale_ids[i:i + chunk_size], run_id)
+            for i in range(0, len(stale_ids), chunk_size)
+        ]
+        if check_employee_tasks:
+            # Probing tasks never fail, otherwise the chord wouldn't match any company
+            job = celery.group(check_employee_tasks) | match_companies.si(company_ids, run_id)
+            job.apply_async()
         else:
+            match_companies.delay(company_ids, run_id)
+
+
+def get_stale_employee_ids(employees):
+    """Returns ids of employees whose users have to be probed before they can be matched."""
+    rows = list(employees.values_list('pk', 'user__telegram_uid'))
+    alive = liveness_registry.get_alive({uid for _, uid in rows if uid})
+    return [pk for pk, uid in rows if uid not in alive]
+
+
+@celery_app.task(bind=True, max_retries=TELEGRAM_MAX_RETRIES)
+def check_employees_in_telegram(self, employee_ids, run_id=None):
+    """
+    Probes users of employees concurrently and switches offline employees who can't be reached.
+    Never fails, otherwise lunch groups wouldn't be created.
+    """
+    with stage('check_employees_in_telegram', run_id):
+        try:
+            retry_after = probe_employees(employee_ids)
+        except Exception:
+            logging.exception('Checking employees in Telegram failed')
+            return
+        if retry_after:
+            if self.request.retries >= self.max_retries:
+                logging.error(f'{len(retry_after)} employees were not checked in Telegram because of rate limits')
+                return
+            raise self.retry(args=(list(retry_after), run_id), countdown=max(retry_after.values()))
+
+
+def probe_employees(employee_ids) -> dict:
+    """Returns employee id → seconds to wait before probing again for employees who hit rate limits."""
+    rows = list(Employee.objects.filter(pk__in=employee_ids).values_list('pk', 'user_id', 'user__telegram_uid'))
+    uids = {pk: uid for pk, _, uid in rows}
+
+    alive, dead, errors = liveness_registry.probe_many(
+        {uid for uid in uids.values() if uid}, settings.TELEGRAM_PROBE_THREADS)
+    offline_ids = {pk for pk, uid in uids.items() if not uid or uid in dead}
+    if offline_ids:
+        Employee.objects.filter(pk__in=offline_ids).update(state=Employee.State.offline)
+        membership_cache.invalidate(*{user_id for pk, user_id, _ in rows if pk in offline_ids})
+        logging.info(f'{len(offline_ids)} employees were switched offline')
+
+    retry_after = {}
+    for uid, e in errors.items():
+        seconds = get_retry_after(e) if isinstance(e, ApiException) else None
+        if seconds is None:
+            # Employees stay online if they couldn't be checked
             logging.error(f'{e}')
+        else:
+            retry_after[uid] = seconds
+    return {pk: retry_after[uid] for pk, uid in uids.items() if uid in retry_after}
 
 
 @celery_app.task
-def create_lunch_groups_for_company(company_id):
-    tasks = []
+def match_companies(company_ids, run_id=None):
+    """
+    Matches employees of all given companies in a process pool and saves their lunch groups.
+    Companies which have lunch today already are skipped, failure of a company doesn't affect the others.
+    Returns seconds matching of every company took.
+    """
+    matcher = AutoMatcher()
+    jobs = []
+    pool = billiard.Pool(settings.PAIR_MATCHER_PROCESSES, initializer=init_matching_process)
+    try:
+        with stage('match_companies', run_id):
+            companies = Company.objects.filter(pk__in=company_ids).exclude(lunches__date=timezone.localdate())
+            for company in companies:
+                with stage('load_company', run_id, company.pk):
+                    employee_ids = get_online_employee_ids(company)
+                    estimator = matcher.get_estimator(company, matcher.make_lunch_map(company))
+                result = pool.apply_async(match_company, (matcher, company, estimator, employee_ids))
+                jobs.append((company, employee_ids, result))
 
-    with transaction.atomic():
-        company = Company.objects.get(pk=company_id)
+            timings = {}
+            for company, employee_ids, result in jobs:
+                try:
+                    groups, seconds = result.get()
+                    logging.info(f'Matched {len(employee_ids)} employees of company `{company}` in {seconds:.2f}s')
+                    record_stage('match_company', run_id, company.pk, seconds)
+                    timings[company.pk] = seconds
+                    save_lunch_groups(company, [[employee_ids[i] for i in group] for group in groups], run_id=run_id)
+                except Exception:
+                    logging.exception(f'Matching of company `{company}` failed')
+    finally:
+        pool.terminate()
+        pool.join()
+    return timings
+
+
+def get_online_employee_ids(company):
+    return list(Employee.objects.filter(company=company, state=Employee.State.online).values_list('pk', flat=True))
+
+
+def save_lunch_groups(company, groups, batch_size=1000, run_id=None):
+    """
+    Saves groups of employee ids as lunch of today with a bounded number of queries
+    and puts notifications of their members to the outbox.
+    Returns ids of created lunch group members.
+    """
+    with stage('save_lunch_groups', run_id, company.pk), transaction.atomic():
         lunch = Lunch.objects.create(company=company, date=timezone.localdate())
-        employees = Employee.objects.filter(company=company, state=Employee.State.online)
-        matcher = MaximumWeightGraphMatcher()
-        groups = matcher.match(company, employees)
-        for group in groups:
-            lunch_group = LunchGroup.objects.create(lunch=lunch)
-            for employee in group:
-                member = LunchGroupMember.objects.create(lunch_group=lunch_group, employee=employee)
-                tasks.append(notify_lunch_group_member.s(member.pk))
+        LunchGroup.objects.bulk_create((LunchGroup(lunch=lunch) for _ in groups), batch_size=batch_size)
+        # Groups are interchangeable, so their ids may be assigned in any order
+        group_ids = LunchGroup.objects.filter(lunch=lunch).values_list('pk', flat=True)
+        LunchGroupMember.objects.bulk_create((
+            LunchGroupMember(lunch_group_id=group_id, employee_id=employee_id)
+            for group_id, group in zip(group_ids, groups) for employee_id in group
+        ), batch_size=batch_size)
+        member_ids = list(LunchGroupMember.objects.filter(lunch_group__lunch=lunch).values_list('pk', flat=True))
+
+        OutboxMessage.objects.bulk_create((
+            OutboxMessage(lunch_group_member_id=pk, chat_id=uid, text=message_html, parse_mode='HTML')
+            for pk, (uid, message_html) in render_notifications(member_ids).items()
+        ), batch_size=batch_size)
+        transaction.on_commit(lambda: send_outbox.delay(run_id=run_id, company_id=company.pk))
 
-    job = celery.group(tasks)
-    job.apply_async()
+    return member_ids
 
 
 @celery_app.task
-def notify_lunch_group_member(pk):
-    member = LunchGroupMember.objects.select_related('employee__user').get(pk=pk)
-    if member.is_notified:
-        return
-    user = member.employee.user
-    if user.telegram_account:
-        lunch_group = member.lunch_group
-        partners = list(LunchGroupMember.objects.filter(lunch_group=lunch_group).exclude(pk=pk))
-        if len(partners) == 1:
-            partner_employee = partners[0].employee
-            # partner_user = partners[0].employee.user
-            # message = __('Hello! Your next random lunch partner is here: [{}](tg://user?id={})').format(
-            #     partner_user.get_full_name(), partner_user.telegram_account.uid)
-            message_html = __('Hello! Your next random lunch partner is here: <a href="tg://user?id={}">{}</a> (@{} - <a href="{}">открыть на портале</a>)').format(
-                partner_employee.user.telegram_account.uid, partner_employee.get_full_name(), partner_employee.user.username, partner_employee.get_external_link())
-        else:
-            partner_employees = (p.employee for p in partners)
-            # partner_users = (p.employee.user for p in partners)
-            # partner_links = (f'[{u.get_full_name() or u.telegram_account.uid}](tg://user?id={u.telegram_account.uid})' for u in partner_users)
-            # message = __('Hello! Your next random lunch partners are here: {}').format(', '.join(partner_links))
-            partner_links_html = (
-            f'<a href="tg://user?id={e.user.telegram_account.uid}">{e.get_full_name()}</a> (@{e.user.username} - <a href="{e.get_external_link()}">открыть на портале</a>)'
-            for e in partner_employees)
-            message_html = __('Hello! Your next random lunch partners are here: {}').format(', '.join(partner_links_html))
-        (
-            send_telegram_message.s(user.pk, message_html, parse_mode='HTML') |
-            mark_lunch_group_member_as_notified.s(pk)
-        ).apply_async()
+def send_outbox(batch_size=100, run_id=None, company_id=None):
+    """
+    Sends pending outbox messages in batches until none are left, only notifications of the company if it's given.
+    Notifications of synthetic companies are sent only if their company is given.
+    Messages of a batch are claimed in a short transaction and sent outside of it,
+    so several senders never send the same message and rows aren't locked while Telegram is called.
+    """
+    with stage('send_outbox', run_id):
+        while True:
+            messages = claim_outbox_messages(batch_size, company_id)
+            if not messages:
+                return
+            retry_after = send_outbox_messages(messages)
+            if retry_after is not None:
+                send_outbox.apply_async(
+                    kwargs=dict(batch_size=batch_size, run_id=run_id, company_id=company_id), countdown=retry_after)
+                return
 
 
-@celery_app.task
-def mark_lunch_group_member_as_notified(message_id, pk):
-    member = LunchGroupMember.objects.get(pk=pk)
-    if member.is_notified:
-        return
-    member.notified_at = timezone.now()
-    member.notification_message_id = message_id
-    member.save()
+def claim_outbox_messages(batch_size: int, company_id: int = None) -> List[OutboxMessage]:
+    messages = OutboxMessage.objects.claimable()
+    if company_id is not None:
+        messages = messages.filter(lunch_group_member__lunch_group__lunch__company_id=company_id)
+    else:
+        # Notifications of synthetic companies are sent only by their dry runs, Telegram doesn't know their chats
+        messages = messages.exclude(lunch_group_member__lunch_group__lunch__company__is_synthetic=True)
+    with transaction.atomic():
+        messages = list(messages.order_by('pk').select_for_update(skip_locked=True)[:batch_size])
+        claimed_until = timezone.now() + timedelta(seconds=OUTBOX_CLAIM_TIMEOUT)
+        OutboxMessage.objects.filter(pk__in=[m.pk for m in messages]).update(claimed_until=claimed_until)
+    return messages
 
 
-@celery_app.task
-def send_telegram_message(user_id: int, message: str, parse_mode: str = None) -> int:
-    user = User.objects.get(pk=user_id)
-    message = bot.send_message(user.telegram_account.uid, message, parse_mode=parse_mode)
+def send_outbox_messages(messages) -> Optional[int]:
+    """
+    Sends messages, saves results and releases claims with bulk updates.
+    Returns seconds to wait before sending the rest if sending had to be stopped.
+    """
+    retry_after = None
+    for message in messages:
+        try:
+            result = bot.send_message(message.chat_id, message.text, parse_mode=message.parse_mode or None)
+        except ApiException as e:
+            retry_after = get_retry_after(e)
+            if retry_after is not None:
+                break
+            logging.error(f'{e}')
+            message.error = str(e)
+        except Exception:
+            logging.exception(f'Sending of outbox message `{message.pk}` failed')
+            retry_after = OUTBOX_RETRY_DELAY
+            break
+        else:
+            message.sent_at = timezone.now()
+            message.message_id = result.message_id
+
+    for message in messages:
+        message.claimed_until = None
+    OutboxMessage.objects.bulk_update(messages, ['sent_at', 'message_id', 'error', 'claimed_until'])
+    LunchGroupMember.objects.bulk_update([
+        LunchGroupMember(pk=m.lunch_group_member_id, notified_at=m.sent_at, notification_message_id=m.message_id)
+        for m in messages if m.lunch_group_member_id and m.sent_at
+    ], ['notified_at', 'notification_message_id'])
+    try:
+        liveness_registry.mark_alive(*(m.chat_id for m in messages if m.sent_at))
+    except RedisError:
+        logging.exception('Notified users were not cached as alive')
+    return retry_after
+
+
+@celery_app.task(bind=True, max_retries=TELEGRAM_MAX_RETRIES)
+def send_telegram_message(self, user_id: int, message: str, parse_mode: str = None) -> int:
+    uid = User.objects.values_list('telegram_uid', flat=True).get(pk=user_id)
+    try:
+        message = bot.send_message(uid, message, parse_mode=parse_mode)
+    except ApiException as e:
+        retry_after = get_retry_after(e)
+        if retry_after is None:
+            raise
+        raise self.retry(exc=e, countdown=retry_after)
     return message.message_id
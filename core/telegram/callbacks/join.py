@@ -6,6 +6,7 @@ from social_django.models import UserSocialAuth, DjangoStorage
 from social_django.strategy import DjangoStrategy
 
 from core.models import Company, Employee
+from core.telegram.router import router
 from core.telegram.state_registry import state_registry
 from lunchegram import bot
 
@@ -13,7 +14,7 @@ from lunchegram import bot
 __all__ = ['join']
 
 
-@bot.message_handler(commands=['join'])
+@router.command('join')
 def join(message):
     bot.send_message(
         message.chat.id,
@@ -28,7 +29,6 @@ def process_join_answer(message):
         company = Company.objects.get(invite_token=invite_token)
     except Company.DoesNotExist:
         bot.reply_to(message, _("Sorry, couldn't find lunch group with the given token. :("))
-        state_registry.del_state(message.from_user.id)
         return
 
     # Authenticate user, create if need to
@@ -47,6 +47,7 @@ def process_join_answer(message):
             user.last_name = from_user.last_name or ''
             user.has_telegram = True
             user.telegram_chat_id = message.chat.id
+            user.telegram_uid = str(from_user.id)
             user.save()
             UserSocialAuth.objects.get_or_create(provider='telegram', uid=from_user.id, defaults={
                 'extra_data': from_user.__dict__,
@@ -4,15 +4,17 @@ from telebot import types
 
 from accounts.models import User
 from core.models import Employee
-from core.telegram.decorators import infuse_user
+from core.telegram.decorators import infuse_user, coalesce_callback_queries
 from core.telegram.keyboards import get_online_keyboard_markup
+from core.telegram.memberships import membership_cache
+from core.telegram.router import router
 from lunchegram import bot
 
 
 __all__ = ['set_online', 'online_callback_query']
 
 
-@bot.message_handler(commands=['online'])
+@router.command('online')
 @infuse_user()
 def set_online(user: Optional[User], message):
     if user:
@@ -22,19 +24,15 @@ def set_online(user: Optional[User], message):
             reply_markup=get_online_keyboard_markup(user))
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith('online'))
+@router.callback('online')
+@coalesce_callback_queries()
 @infuse_user()
-def online_callback_query(user: Optional[User], query: types.CallbackQuery):
-    data = query.data
-    company_id = data.split(':')[1]
+def online_callback_query(user: Optional[User], query: types.CallbackQuery, company_id: str):
     if user:
-        try:
-            employee = Employee.objects.filter(user=user, company_id=company_id, state=Employee.State.offline).get()
-        except Employee.DoesNotExist:
-            pass
-        else:
-            employee.state = Employee.State.online
-            employee.save()
+        updated = Employee.objects.filter(
+            user=user, company_id=company_id, state=Employee.State.offline).update(state=Employee.State.online)
+        if updated:
+            membership_cache.set_state(user.pk, company_id, Employee.State.online)
             bot.edit_message_reply_markup(
                 chat_id=query.message.chat.id,
                 message_id=query.message.message_id,
@@ -1,11 +1,12 @@
 from core.telegram.decorators import infuse_user
+from core.telegram.router import router
 from lunchegram import bot
 
 
 __all__ = ['test']
 
 
-@bot.message_handler(commands=['test'])
+@router.command('test')
 @infuse_user()
 def test(user, message):
     bot.send_message(
@@ -1,5 +1,6 @@
 from django.utils.translation import gettext as _
 
+from core.telegram.router import router
 from core.telegram.state_registry import state_registry, NoStateException
 from lunchegram import bot
 
@@ -7,7 +8,7 @@ from lunchegram import bot
 __all__ = ['echo_message']
 
 
-@bot.message_handler(func=lambda message: True, content_types=['text'])
+@router.fallback
 def echo_message(message):
     try:
         state_registry.process_message(message)
@@ -2,13 +2,14 @@ from telebot.types import Message
 
 from accounts.models import User
 from core.telegram.decorators import infuse_user
+from core.telegram.router import router
 from lunchegram import bot
 
 
 __all__ = ['send_welcome']
 
 
-@bot.message_handler(commands=['help', 'start'])
+@router.command('help', 'start')
 @infuse_user()
 def send_welcome(user: User, message: Message):
     bot.send_message(
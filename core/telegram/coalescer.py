@@ -0,0 +1,35 @@
+import logging
+
+from django.conf import settings
+from redis import RedisError
+
+from core.utils import get_redis
+
+
+def _make_presses_key(uid, message_id):
+    return f'callback:{uid}:{message_id}'
+
+
+class CallbackCoalescer:
+    """
+    Remembers buttons pressed by a user under a message for a short window,
+    so that repeated presses of the same button are handled once.
+    """
+    def __init__(self, window=settings.TELEGRAM_CALLBACK_COALESCE_WINDOW):
+        self.redis = get_redis()
+        self.window = window
+
+    def is_first_press(self, uid, message_id, data: str) -> bool:
+        key = _make_presses_key(uid, message_id)
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.sadd(key, data)
+            pipeline.expire(key, self.window)
+            added, _ = pipeline.execute()
+        except RedisError:
+            logging.exception(f'Could not check press of `{data}` button')
+            return True
+        return bool(added)
+
+
+callback_coalescer = CallbackCoalescer()
@@ -2,14 +2,18 @@ from functools import wraps
 
 from django.db import transaction
 
-from accounts.models import User
 from core.models import TelegramChat
+from core.telegram.coalescer import callback_coalescer
+from core.telegram.liveness import liveness_registry
+from core.telegram.prefetch import get_prefetched_users
+from core.telegram.user_cache import telegram_user_cache
+from lunchegram import bot
 
 
 def infuse_user():
     """
     Adds user instance to args if possible.
-    Also creates
+    Also creates Telegram chat of the user if it's not known yet.
     """
     def decorator(func):
         @wraps(func)
@@ -17,11 +21,17 @@ def infuse_user():
             message = args[0]
 
             uid = message.from_user.id
-            user = User.objects.get_from_telegram_uid(uid)
-
-            if hasattr(message, 'chat'):
-                with transaction.atomic():
-                    TelegramChat.objects.get_or_create(uid=uid, defaults=dict(chat_id=message.chat.id))
+            liveness_registry.touch(uid)
+
+            prefetched_users = get_prefetched_users()
+            if str(uid) in prefetched_users:
+                user = prefetched_users[str(uid)]
+            else:
+                user = telegram_user_cache.get_user(uid)
+                if hasattr(message, 'chat') and not telegram_user_cache.is_chat_known(uid):
+                    with transaction.atomic():
+                        TelegramChat.objects.get_or_create(uid=uid, defaults=dict(chat_id=message.chat.id))
+                    telegram_user_cache.add_chat(uid)
 
             args = (user,) + args
             return func(*args, **kwargs)
@@ -29,3 +39,24 @@ def infuse_user():
         return wrapper
 
     return decorator
+
+
+def coalesce_callback_queries():
+    """
+    Handles only the first press of a button in a burst of presses of it, others are just answered.
+    Has to be applied before `infuse_user`, so that repeated presses don't look up the user.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            query = args[0]
+
+            message_id = query.message.message_id if query.message else query.inline_message_id
+            if not callback_coalescer.is_first_press(query.from_user.id, message_id, query.data):
+                bot.answer_callback_query(query.id, show_alert=False)
+                return
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
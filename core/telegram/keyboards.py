@@ -2,25 +2,23 @@ from telebot import types
 
 from accounts.models import User
 from core.models import Employee
+from core.telegram.memberships import membership_cache
 
 
-def get_offline_keyboard_markup(user: User):
+def get_keyboard_markup(user: User, state: str, action: str):
     markup = types.InlineKeyboardMarkup(row_width=1)
     buttons = []
-    employees = Employee.objects.filter(user=user, state=Employee.State.online).select_related('company')
-    for employee in employees:
-        company = employee.company
-        buttons.append(types.InlineKeyboardButton(company.name, callback_data=f'offline:{company.pk}'))
+    for membership in membership_cache.get(user.pk):
+        if membership.state == state:
+            buttons.append(types.InlineKeyboardButton(
+                membership.company_name, callback_data=f'{action}:{membership.company_id}'))
     markup.add(*buttons)
     return markup
 
 
+def get_offline_keyboard_markup(user: User):
+    return get_keyboard_markup(user, Employee.State.online, 'offline')
+
+
 def get_online_keyboard_markup(user: User):
-    markup = types.InlineKeyboardMarkup(row_width=1)
-    buttons = []
-    employees = Employee.objects.filter(user=user, state=Employee.State.offline).select_related('company')
-    for employee in employees:
-        company = employee.company
-        buttons.append(types.InlineKeyboardButton(company.name, callback_data=f'online:{company.pk}'))
-    markup.add(*buttons)
-    return markup
+    return get_keyboard_markup(user, Employee.State.offline, 'online')
@@ -0,0 +1,123 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Iterable, Set, Tuple, Dict, Any
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from redis import RedisError
+from telebot.apihelper import ApiException
+
+from core.models import TelegramChat, OutboxMessage
+from core.telegram.user_cache import LRUCache
+from core.utils import get_redis
+from lunchegram import bot
+
+
+def _make_liveness_key(uid):
+    return f'alive:{uid}'
+
+
+class LivenessRegistry:
+    """
+    Remembers Telegram users who recently proved they still talk to the bot,
+    so the bot doesn't have to probe them before every lunch.
+    """
+    def __init__(self, ttl=settings.TELEGRAM_LIVENESS_TTL, touch_interval=60*60):
+        self.redis = get_redis()
+        self.ttl = ttl
+        # Users touched by this process recently, they are alive for a while at least
+        self._touched = LRUCache(ttl=min(touch_interval, ttl))
+
+    def mark_alive(self, *uids):
+        if not uids:
+            return
+        pipeline = self.redis.pipeline(transaction=False)
+        for uid in uids:
+            pipeline.set(_make_liveness_key(uid), 1, ex=self.ttl)
+        pipeline.execute()
+
+    def touch(self, uid):
+        """
+        Marks user who interacted with the bot alive if their mark has expired.
+        Redis is checked at most once per `touch_interval` for a user, the mark is only written if it's missing.
+        """
+        uid = str(uid)
+        if self._touched.get(uid):
+            return
+        # Redis isn't tried again for a while if it fails, so updates aren't delayed by every attempt
+        self._touched.set(uid, True)
+        try:
+            self.redis.set(_make_liveness_key(uid), 1, ex=self.ttl, nx=True)
+        except RedisError:
+            # User's command must not fail because of liveness, the user is probed before lunch at worst
+            logging.exception(f'User `{uid}` was not marked alive')
+
+    def get_alive(self, uids: Iterable) -> Set[str]:
+        """
+        Returns uids which are cached as alive or had recent chat activity or message deliveries.
+        Users found in the database are cached as alive too.
+        """
+        uids = [str(uid) for uid in uids]
+        if not uids:
+            return set()
+        cached = self.redis.mget([_make_liveness_key(uid) for uid in uids])
+        alive = {uid for uid, value in zip(uids, cached) if value is not None}
+
+        stale = [uid for uid in uids if uid not in alive]
+        if stale:
+            since = timezone.now() - timedelta(seconds=self.ttl)
+            active = set(TelegramChat.objects.filter(
+                Q(created__gte=since) | Q(modified__gte=since), uid__in=stale).values_list('uid', flat=True))
+            active.update(OutboxMessage.objects.filter(
+                chat_id__in=stale, sent_at__gte=since).values_list('chat_id', flat=True))
+            if active:
+                self.mark_alive(*active)
+            alive |= active
+        return alive
+
+    def probe(self, uid) -> bool:
+        """
+        Checks if user hasn't blocked the bot with a chat action which isn't visible in the chat history.
+        Other API errors are raised.
+        """
+        is_alive = self._send_probe(uid)
+        if is_alive:
+            self.mark_alive(uid)
+        return is_alive
+
+    def probe_many(self, uids: Iterable, max_workers: int) -> Tuple[Set, Set, Dict[Any, Exception]]:
+        """
+        Probes users in a bounded thread pool, every thread keeps its own HTTP session of the bot.
+        Returns alive and dead uids and errors of the others, e.g. API, network or Redis errors.
+        """
+        alive, dead, errors = set(), set(), {}
+
+        def send_probe(uid):
+            try:
+                (alive if self._send_probe(uid) else dead).add(uid)
+            except Exception as e:
+                errors[uid] = e
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(send_probe, uids))
+        try:
+            self.mark_alive(*alive)
+        except RedisError:
+            logging.exception('Probed users were not cached as alive')
+        return alive, dead, errors
+
+    @staticmethod
+    def _send_probe(uid) -> bool:
+        try:
+            bot.send_chat_action(uid, 'typing')
+        except ApiException as e:
+            # Bot was blocked or user was deactivated
+            if e.result.status_code == 403:
+                return False
+            raise
+        return True
+
+
+liveness_registry = LivenessRegistry()
@@ -0,0 +1,91 @@
+import logging
+from typing import List
+
+import attr
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from redis import RedisError
+
+from core.models import Company, Employee
+from core.utils import get_redis
+
+# Marks complete entries, hash without it was partially written by `set_state` after expiration
+_LOADED_FIELD = b'loaded'
+
+
+def _make_memberships_key(user_id):
+    return f'memberships:{user_id}'
+
+
+@attr.s(slots=True, frozen=True)
+class Membership:
+    company_id = attr.ib(type=int)
+    company_name = attr.ib(type=str)
+    state = attr.ib(type=str)
+
+
+class MembershipCache:
+    """
+    Companies of a user with their employee states, kept in Redis so that keyboards are rendered without queries.
+    States are updated in place by the bot, other changes of employees and companies invalidate entries.
+    """
+    def __init__(self, ttl=24*60*60):
+        self.redis = get_redis()
+        self.ttl = ttl
+
+    def get(self, user_id) -> List[Membership]:
+        key = _make_memberships_key(user_id)
+        values = self.redis.hgetall(key)
+        if _LOADED_FIELD in values:
+            memberships = []
+            for field, value in values.items():
+                field = field.decode('utf-8')
+                if field.startswith('name:'):
+                    company_id = field[len('name:'):]
+                    state = values[f'state:{company_id}'.encode('utf-8')].decode('utf-8')
+                    memberships.append(Membership(int(company_id), value.decode('utf-8'), state))
+            return sorted(memberships, key=lambda m: (m.company_name, m.company_id))
+
+        rows = Employee.objects.filter(user_id=user_id).values_list('company_id', 'company__name', 'state')
+        memberships = [Membership(*row) for row in rows]
+        mapping = {_LOADED_FIELD: 1}
+        for m in memberships:
+            mapping[f'name:{m.company_id}'] = m.company_name
+            mapping[f'state:{m.company_id}'] = m.state
+        pipeline = self.redis.pipeline()
+        pipeline.delete(key)
+        pipeline.hmset(key, mapping)
+        pipeline.expire(key, self.ttl)
+        pipeline.execute()
+        return sorted(memberships, key=lambda m: (m.company_name, m.company_id))
+
+    def set_state(self, user_id, company_id, state: str):
+        key = _make_memberships_key(user_id)
+        pipeline = self.redis.pipeline()
+        pipeline.hset(key, f'state:{company_id}', state)
+        pipeline.expire(key, self.ttl)
+        pipeline.execute()
+
+    def invalidate(self, *user_ids):
+        if not user_ids:
+            return
+        try:
+            self.redis.delete(*(_make_memberships_key(user_id) for user_id in user_ids))
+        except RedisError:
+            # Saving employees must not fail because of the cache, entries expire anyway
+            logging.exception('Memberships cache was not invalidated')
+
+
+membership_cache = MembershipCache()
+
+
+@receiver(post_save, sender=Employee)
+@receiver(post_delete, sender=Employee)
+def invalidate_employee(sender, instance: Employee, **kwargs):
+    membership_cache.invalidate(instance.user_id)
+
+
+@receiver(post_save, sender=Company)
+def invalidate_company(sender, instance: Company, created, **kwargs):
+    if not created:
+        membership_cache.invalidate(*instance.employee_set.values_list('user_id', flat=True))
@@ -0,0 +1,41 @@
+import threading
+from contextlib import contextmanager
+from typing import List
+
+from accounts.models import User
+from core.models import TelegramChat
+
+_local = threading.local()
+
+
+def _get_updated_objects(update):
+    return [o for o in (update.message, update.edited_message, update.callback_query) if o is not None]
+
+
+@contextmanager
+def prefetch_updates(updates: List):
+    """
+    Loads users and Telegram chats of all updates of a batch at once, `infuse_user` takes them from here.
+    """
+    objects = [o for update in updates for o in _get_updated_objects(update)]
+    uids = {str(o.from_user.id) for o in objects}
+    users = dict.fromkeys(uids)
+    for user in User.objects.filter(telegram_uid__in=uids):
+        users[user.telegram_uid] = user
+
+    chats = {str(o.from_user.id): o.chat.id for o in objects if hasattr(o, 'chat')}
+    known_chats = set(TelegramChat.objects.filter(uid__in=chats).values_list('uid', flat=True))
+    TelegramChat.objects.bulk_create(
+        [TelegramChat(uid=uid, chat_id=chat_id) for uid, chat_id in chats.items() if uid not in known_chats],
+        ignore_conflicts=True)
+
+    _local.users = users
+    try:
+        yield
+    finally:
+        del _local.users
+
+
+def get_prefetched_users() -> dict:
+    """Returns Telegram uid → user (or None) of updates being processed, chats of those users already exist."""
+    return getattr(_local, 'users', {})
@@ -0,0 +1,68 @@
+import logging
+from typing import Callable, Dict, Optional
+
+from telebot import types, util
+
+from lunchegram import bot
+
+
+class Router:
+    """
+    Dispatches messages by command and callback queries by data prefix with dict lookups,
+    so the bot doesn't test every registered handler in turn.
+    Callback data has `prefix:argument` format, the argument is passed to the handler after the query.
+    Text messages without known commands go to the fallback handler.
+    """
+    def __init__(self):
+        self._commands: Dict[str, Callable] = {}
+        self._callbacks: Dict[str, Callable] = {}
+        self._fallback: Optional[Callable] = None
+        self._bot = None
+
+    def command(self, *commands: str):
+        def registrator(func):
+            for command in commands:
+                assert command not in self._commands, f'Handler for command `{command}` is registered already'
+                self._commands[command] = func
+            return func
+        return registrator
+
+    def callback(self, prefix: str):
+        def registrator(func):
+            assert prefix not in self._callbacks, f'Handler for callback `{prefix}` is registered already'
+            self._callbacks[prefix] = func
+            return func
+        return registrator
+
+    def fallback(self, func):
+        self._fallback = func
+        return func
+
+    def dispatch_message(self, message: types.Message):
+        handler = None
+        if util.is_command(message.text):
+            handler = self._commands.get(util.extract_command(message.text))
+        handler = handler or self._fallback
+        if handler is not None:
+            handler(message)
+
+    def dispatch_callback_query(self, query: types.CallbackQuery):
+        prefix, _, argument = (query.data or '').partition(':')
+        handler = self._callbacks.get(prefix)
+        if handler is None:
+            logging.warning(f'Unknown callback data `{query.data}`')
+            # Otherwise the client shows progress until it times out
+            self._bot.answer_callback_query(query.id)
+            return
+        handler(query, argument)
+
+    def install(self, bot):
+        """Registers the router as the only message and callback query handler of the bot."""
+        self._bot = bot
+        bot.message_handler(content_types=['text'])(self.dispatch_message)
+        # Builtin accepts every query without a call of Python function
+        bot.callback_query_handler(func=bool)(self.dispatch_callback_query)
+
+
+router = Router()
+router.install(bot)
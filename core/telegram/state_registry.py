@@ -24,15 +24,30 @@ class StateRegistry:
         return registrator
 
     def process_message(self, message):
-        state = self._get_state(message.from_user.id)
+        """
+        Passes message to the handler of the user's state. The state is cleared,
+        handlers which expect another answer have to set it again.
+        If the handler fails, the state is restored so the user can answer once more.
+        """
+        user_id = message.from_user.id
+        state = self.pop_state(user_id)
         if state is None:
             raise NoStateException
         assert state in self._handlers, f'Registered handler for state `{state}` not found'
-        self._handlers[state](message)
-
-    def _get_state(self, user_id) -> Optional[str]:
+        try:
+            self._handlers[state](message)
+        except Exception:
+            # Doesn't overwrite a state the handler has set before failing
+            self.redis.set(_make_state_key(user_id), state, ex=self.state_ttl, nx=True)
+            raise
+
+    def pop_state(self, user_id) -> Optional[str]:
+        """Returns state of the user and clears it atomically in a single round-trip."""
         state_key = _make_state_key(user_id)
-        state = self.redis.get(state_key)
+        pipeline = self.redis.pipeline()
+        pipeline.get(state_key)
+        pipeline.delete(state_key)
+        state, _ = pipeline.execute()
         return state.decode('utf-8') if state else state
 
     def set_state(self, user_id, new_state):
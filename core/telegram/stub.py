@@ -0,0 +1,85 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from itertools import count
+
+from requests import Response
+from telebot import apihelper
+from telebot.apihelper import ApiException
+
+
+def make_response(status_code: int, description: str, **parameters) -> Response:
+    response = Response()
+    response.status_code = status_code
+    body = {'ok': False, 'error_code': status_code, 'description': description}
+    if parameters:
+        body['parameters'] = parameters
+    response._content = json.dumps(body).encode('utf-8')
+    return response
+
+
+class TelegramStub:
+    """
+    In-process stand-in for Telegram Bot API used by dry runs.
+    Records calls and injects latency, 429 Too Many Requests and 403 Forbidden errors.
+    """
+    def __init__(self, latency: float = 0.0, too_many_requests_rate: float = 0.0, forbidden_rate: float = 0.0,
+                 retry_after: int = 1):
+        self.latency = latency
+        self.too_many_requests_rate = too_many_requests_rate
+        self.forbidden_rate = forbidden_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.errors = Counter()
+        self._message_ids = count(1)
+        self._lock = threading.Lock()
+        self._original_make_request = None
+
+    def install(self):
+        """Routes all API calls of the bot to the stub."""
+        if self._original_make_request is None:
+            self._original_make_request = apihelper._make_request
+            apihelper._make_request = self.make_request
+
+    def uninstall(self):
+        if self._original_make_request is not None:
+            apihelper._make_request = self._original_make_request
+            self._original_make_request = None
+
+    def make_request(self, token, method_name, method='get', params=None, files=None, **kwargs):
+        params = params or {}
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[method_name] += 1
+
+        if 'chat_id' in params:
+            value = random.random()
+            if value < self.too_many_requests_rate:
+                self._fail(method_name, make_response(
+                    429, f'Too Many Requests: retry after {self.retry_after}', retry_after=self.retry_after))
+            if value < self.too_many_requests_rate + self.forbidden_rate:
+                self._fail(method_name, make_response(403, 'Forbidden: bot was blocked by the user'))
+
+        if method_name in ('sendMessage', 'editMessageReplyMarkup'):
+            with self._lock:
+                message_id = params.get('message_id') or next(self._message_ids)
+            return {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': params['chat_id'], 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        if method_name == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Lunchegram', 'username': 'lunchegram_stub_bot'}
+        return True
+
+    def _fail(self, method_name, response: Response):
+        with self._lock:
+            self.errors[response.status_code] += 1
+        raise ApiException(response.json()['description'], method_name, response)
+
+
+telegram_stub = TelegramStub()
@@ -0,0 +1,114 @@
+import json
+import logging
+from typing import List
+
+import telebot
+from django.conf import settings
+from django.db import close_old_connections
+from redis import RedisError
+
+from core.instrumentation import increment_counter
+from core.telegram.prefetch import prefetch_updates
+from core.utils import get_redis
+from lunchegram import bot
+
+UPDATES_KEY = 'telegram:updates'
+
+
+class InvalidUpdate(Exception):
+    pass
+
+
+def validate_update(json_string: str) -> dict:
+    try:
+        data = json.loads(json_string)
+    except ValueError as e:
+        raise InvalidUpdate(str(e))
+    if not isinstance(data, dict) or not isinstance(data.get('update_id'), int):
+        raise InvalidUpdate('Update has no `update_id`')
+    return data
+
+
+def _make_seen_update_key(update_id):
+    return f'telegram:seen_update:{update_id}'
+
+
+class SeenUpdates:
+    """
+    Remembers ids of received updates for a short time.
+    Telegram re-delivers updates when the webhook responds slowly, those duplicates are dropped.
+    """
+    def __init__(self, ttl=settings.TELEGRAM_SEEN_UPDATES_TTL):
+        self.redis = get_redis()
+        self.ttl = ttl
+
+    def add(self, update_id: int) -> bool:
+        """Returns False if the update was received already."""
+        try:
+            is_new = self.redis.set(_make_seen_update_key(update_id), 1, nx=True, ex=self.ttl)
+        except RedisError:
+            # Processing an update twice is better than losing it
+            logging.exception(f'Could not check update `{update_id}`')
+            return True
+        if not is_new:
+            increment_counter('duplicate_updates')
+        return bool(is_new)
+
+    def discard(self, update_id: int):
+        """Forgets the update which couldn't be processed, so that its re-delivery by Telegram is accepted."""
+        try:
+            self.redis.delete(_make_seen_update_key(update_id))
+        except RedisError:
+            logging.exception(f'Could not discard update `{update_id}`')
+
+
+class UpdateQueue:
+    """Redis list of raw updates received by the webhook and processed by `process_updates` command"""
+    def __init__(self, key=UPDATES_KEY):
+        self.redis = get_redis()
+        self.key = key
+
+    def push(self, json_string: str):
+        self.redis.rpush(self.key, json_string)
+
+    def pop_batch(self, batch_size: int, timeout: int) -> List[str]:
+        """Waits up to `timeout` seconds for an update, returns it with up to `batch_size - 1` more."""
+        item = self.redis.blpop(self.key, timeout=timeout)
+        if item is None:
+            return []
+        pipeline = self.redis.pipeline()
+        pipeline.lrange(self.key, 0, batch_size - 2)
+        pipeline.ltrim(self.key, batch_size - 1, -1)
+        rest, _ = pipeline.execute()
+        return [item[1]] + rest
+
+
+def process_raw_updates(raw_updates: List[bytes]):
+    updates = []
+    for raw_update in raw_updates:
+        try:
+            updates.append(telebot.types.Update.de_json(raw_update.decode('utf-8')))
+        except Exception:
+            logging.exception(f'Could not decode update {raw_update!r}')
+    process_updates(updates)
+
+
+def process_updates(updates: List[telebot.types.Update]):
+    """
+    Processes a batch of updates with prefetched users.
+    Updates are processed one by one, so a failing handler doesn't affect other updates of the batch.
+    """
+    close_old_connections()
+    try:
+        with prefetch_updates(updates):
+            for update in updates:
+                try:
+                    bot.process_new_updates([update])
+                except Exception:
+                    logging.exception(f'Could not process update `{update.update_id}`')
+    finally:
+        close_old_connections()
+
+
+seen_updates = SeenUpdates()
+update_queue = UpdateQueue()
@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from redis import RedisError
+from social_django.models import UserSocialAuth
+
+from accounts.models import User
+from core.utils import get_redis
+
+_MISSING = object()
+
+
+def _make_user_key(uid):
+    return f'tg:user:{uid}'
+
+
+def _make_chat_key(uid):
+    return f'tg:chat:{uid}'
+
+
+class LRUCache:
+    """In-process cache of limited size, entries expire after `ttl` seconds so changes from other processes apply."""
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[1] <= time.monotonic():
+                return default
+            self._items.move_to_end(key)
+            return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+
+class TelegramUserCache:
+    """
+    Resolves Telegram uid to user id and remembers known chats.
+    Values are kept in process memory and in Redis, uid → user id entries are invalidated by model signals.
+    Users themselves are loaded from the database, so deactivation applies at once.
+    Redis is optional, the database is used while it's unavailable.
+    """
+    def __init__(self, ttl=24*60*60):
+        self.redis = get_redis()
+        self.ttl = ttl
+        self._user_ids = LRUCache()
+        self._chats = LRUCache()
+
+    def get_user_id(self, uid) -> Optional[int]:
+        uid = str(uid)
+        user_id = self._user_ids.get(uid, _MISSING)
+        if user_id is not _MISSING:
+            return user_id
+
+        try:
+            value = self.redis.get(_make_user_key(uid))
+        except RedisError:
+            logging.exception('Telegram user cache is unavailable')
+            return User.objects.filter(telegram_uid=uid).values_list('pk', flat=True).first()
+
+        if value is not None:
+            user_id = int(value) if value else None
+        else:
+            user_id = User.objects.filter(telegram_uid=uid).values_list('pk', flat=True).first()
+            try:
+                # Empty value means there is no user with such uid
+                self.redis.set(_make_user_key(uid), user_id or '', ex=self.ttl)
+            except RedisError:
+                logging.exception('Telegram user cache is unavailable')
+        self._user_ids.set(uid, user_id)
+        return user_id
+
+    def get_user(self, uid) -> Optional[User]:
+        user_id = self.get_user_id(uid)
+        if user_id is None:
+            return None
+        return User.objects.filter(pk=user_id).first()
+
+    def invalidate(self, uid):
+        uid = str(uid)
+        self._user_ids.delete(uid)
+        try:
+            self.redis.delete(_make_user_key(uid))
+        except RedisError:
+            # Saving users must not fail because of the cache, entries expire anyway
+            logging.exception('Telegram user cache was not invalidated')
+
+    def is_chat_known(self, uid) -> bool:
+        uid = str(uid)
+        if self._chats.get(uid):
+            return True
+        try:
+            exists = self.redis.exists(_make_chat_key(uid))
+        except RedisError:
+            # Chat is looked up in the database then
+            logging.exception('Telegram chats cache is unavailable')
+            return False
+        if exists:
+            self._chats.set(uid, True)
+            return True
+        return False
+
+    def add_chat(self, uid):
+        uid = str(uid)
+        self._chats.set(uid, True)
+        try:
+            self.redis.set(_make_chat_key(uid), 1, ex=self.ttl)
+        except RedisError:
+            logging.exception('Telegram chats cache is unavailable')
+
+
+telegram_user_cache = TelegramUserCache()
+
+
+@receiver(post_save, sender=UserSocialAuth)
+@receiver(post_delete, sender=UserSocialAuth)
+def invalidate_social_user(sender, instance: UserSocialAuth, **kwargs):
+    if instance.provider == 'telegram':
+        telegram_user_cache.invalidate(instance.uid)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user(sender, instance: User, **kwargs):
+    # Previous uid of the user mustn't resolve to the user anymore
+    for uid in {instance.telegram_uid, instance.tracker.previous('telegram_uid')}:
+        if uid:
+            telegram_user_cache.invalidate(uid)
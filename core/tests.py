@@ -1,7 +1,48 @@
-from django.test import TestCase
+import json
+from datetime import date, timedelta
+from io import StringIO
+from unittest import mock
 
+import numpy as np
+import telebot
+from celery.exceptions import Retry
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from redis import RedisError
+from requests import Response
+from telebot.apihelper import ApiException
+
+from accounts.models import User
 from core.factories import CompanyFactory, EmployeeFactory
-from core.pair_matcher import MaximumWeightGraphMatcher
+from core.instrumentation import stage, record_telegram_call
+from core.models import Company, Employee, Lunch, LunchGroup, LunchGroupMember, OutboxMessage, PipelineRun, TelegramChat
+from core.pair_matcher import (
+    MaximumWeightGraphMatcher, LunchMap, NEVER_MET_BONUS, DecayEstimator, GreedyMatcher, AutoMatcher,
+    match_company, get_sparse_edges, BLOCK_SIZE,
+)
+from core.notifications import render_notifications
+from core.rate_limiter import get_retry_after, RateLimitTimeout
+from core.synthetic import create_synthetic_company, delete_synthetic_companies
+from core.tasks import (
+    save_lunch_groups, send_outbox, match_companies, create_lunch_groups, check_employees_in_telegram,
+    get_online_employee_ids,
+)
+from core.telegram.decorators import coalesce_callback_queries
+from core.telegram.liveness import LivenessRegistry
+from core.telegram.memberships import MembershipCache, Membership
+from core.telegram.prefetch import prefetch_updates, get_prefetched_users
+from core.telegram.router import Router
+from core.telegram.state_registry import StateRegistry, NoStateException
+from core.telegram.stub import TelegramStub
+from core.telegram.updates import validate_update, InvalidUpdate, UpdateQueue, UPDATES_KEY
+from core.telegram.user_cache import LRUCache, TelegramUserCache
+from lunchegram.telebot import RateLimitedTeleBot
 
 
 class PairMatcherTestCase(TestCase):
@@ -17,3 +58,715 @@ class PairMatcherTestCase(TestCase):
                 e.user.username for e in group
             ) for group in groups]
         ))
+
+    def test_lunch_map(self):
+        employees = EmployeeFactory.create_batch(4, company=self.company)
+        for lunch_date, pairs in [(date(2020, 1, 6), [(0, 1), (2, 3)]), (date(2020, 1, 13), [(0, 1, 2), ])]:
+            lunch = Lunch.objects.create(company=self.company, date=lunch_date)
+            for pair in pairs:
+                lunch_group = LunchGroup.objects.create(lunch=lunch)
+                for i in pair:
+                    LunchGroupMember.objects.create(lunch_group=lunch_group, employee=employees[i])
+
+        with self.assertNumQueries(1):
+            lunch_map = LunchMap.for_company(self.company)
+        self.assertEqual(len(lunch_map), 4)
+        pair = lunch_map.get(employees[1].pk, employees[0].pk)
+        self.assertEqual((pair.last_date, pair.times_met), (date(2020, 1, 13), 2))
+        self.assertIsNone(lunch_map.get(employees[1].pk, employees[3].pk))
+
+        with self.assertNumQueries(1):
+            groups = MaximumWeightGraphMatcher().match(self.company, employees)
+        self.assertEqual(sum(len(g) for g in groups), 4)
+
+    def test_weight_matrix(self):
+        employees = EmployeeFactory.create_batch(3, company=self.company)
+        lunch = Lunch.objects.create(company=self.company, date=timezone.localdate())
+        lunch_group = LunchGroup.objects.create(lunch=lunch)
+        for employee in employees[:2]:
+            LunchGroupMember.objects.create(lunch_group=lunch_group, employee=employee)
+
+        matcher = MaximumWeightGraphMatcher()
+        weights = matcher.get_weight_matrix(self.company, employees)
+        self.assertTrue((weights == weights.T).all())
+        self.assertTrue((weights.diagonal() == 0).all())
+        self.assertLess(weights[0, 1], NEVER_MET_BONUS)
+        self.assertGreaterEqual(weights[0, 2], NEVER_MET_BONUS)
+
+        groups = matcher.match(self.company, employees, weights=weights)
+        self.assertEqual(groups, {frozenset(employees)})
+
+        # Big matrices are filled by blocks of rows
+        weights = DecayEstimator().get_weight_matrix(list(range(BLOCK_SIZE * 2 + 1)))
+        self.assertEqual(weights.dtype, np.float32)
+        self.assertTrue((weights == weights.T).all())
+        self.assertTrue((weights.diagonal() == 0).all())
+        self.assertTrue((np.delete(weights, 0, axis=1)[0] >= NEVER_MET_BONUS).all())
+        rows, cols = get_sparse_edges(weights, 3)
+        best = np.argsort(-(weights + np.diag(np.full(len(weights), -np.inf))), axis=1)[:, :3]
+        self.assertEqual(
+            set(zip(rows.tolist(), cols.tolist())),
+            {(min(i, j), max(i, j)) for i, partners in enumerate(best.tolist()) for j in partners})
+
+    def test_decay_estimator(self):
+        self.company.pair_decay_days = 30
+        self.company.repeat_pair_penalty = 1
+        estimator = DecayEstimator.for_company(self.company)
+        bonus = estimator.get_met_bonus(np.array([0, 7, 60, 60]), np.array([1, 1, 1, 3]))
+        self.assertEqual(bonus[0], 0)
+        self.assertLess(bonus[1], bonus[2])
+        self.assertLess(bonus[2], NEVER_MET_BONUS)
+        self.assertAlmostEqual(bonus[3], bonus[2] / 3)
+
+        with self.assertRaises(ValidationError):
+            Company._meta.get_field('repeat_pair_penalty').clean(-1, self.company)
+        self.company.repeat_pair_penalty = -1
+        bonus = DecayEstimator.for_company(self.company).get_met_bonus(np.array([60, 60]), np.array([1, 3]))
+        self.assertEqual(bonus[0], bonus[1])
+
+    def test_sparse(self):
+        employees = EmployeeFactory.create_batch(41, company=self.company)
+        matcher = MaximumWeightGraphMatcher(sparse_threshold=2, sparse_k=3, sparse_random=1)
+        groups = matcher.match(self.company, employees)
+        self.assertEqual(set().union(*groups), set(employees))
+
+        # Sparse graph is a star here, so complete graph has to be used
+        weights = np.ones((6, 6))
+        weights[0, :] = weights[:, 0] = 10
+        np.fill_diagonal(weights, 0)
+        matcher = MaximumWeightGraphMatcher(sparse_threshold=2, sparse_k=1, sparse_random=0)
+        with self.assertLogs(level='INFO'):
+            groups = matcher.match(self.company, employees[:6], weights=weights)
+        self.assertEqual(len(groups), 3)
+
+    def test_greedy(self):
+        employees = EmployeeFactory.create_batch(41, company=self.company)
+        for matcher in [GreedyMatcher(), GreedyMatcher(sparse_threshold=2, sparse_k=2)]:
+            groups = matcher.match(self.company, employees)
+            self.assertEqual(set().union(*groups), set(employees))
+            self.assertEqual(sum(len(g) for g in groups), 41)
+
+        # Greedy takes 0-1 edge first, improvement swaps partners to 0-2 and 1-3
+        weights = np.array([
+            [0, 5, 4, 0],
+            [5, 0, 0, 4],
+            [4, 0, 0, 1],
+            [0, 4, 1, 0],
+        ])
+        groups = GreedyMatcher().match(self.company, employees[:4], weights=weights)
+        self.assertEqual(groups, {frozenset(employees[i] for i in g) for g in [(0, 2), (1, 3)]})
+
+    def test_single_employee(self):
+        employees = EmployeeFactory.create_batch(1, company=self.company)
+        for matcher in [GreedyMatcher(), AutoMatcher()]:
+            self.assertEqual(matcher.match(self.company, employees), set())
+
+    def test_auto(self):
+        employees = EmployeeFactory.create_batch(41, company=self.company)
+        groups = AutoMatcher().match(self.company, employees)
+        self.assertEqual(set().union(*groups), set(employees))
+
+        with self.assertLogs(level='WARNING'):
+            groups = AutoMatcher(time_budget=0).match(self.company, employees)
+        self.assertEqual(set().union(*groups), set(employees))
+
+    def test_match_company(self):
+        employees = EmployeeFactory.create_batch(41, company=self.company)
+        matcher = AutoMatcher()
+        estimator = matcher.get_estimator(self.company, matcher.make_lunch_map(self.company))
+        groups, seconds = match_company(matcher, self.company, estimator, [e.pk for e in employees])
+        self.assertEqual(set().union(*groups), set(range(41)))
+        self.assertEqual(len(groups), 20)
+        self.assertGreaterEqual(seconds, 0)
+
+
+class MatchCompaniesTestCase(TestCase):
+    @mock.patch('core.tasks.save_lunch_groups')
+    def test_match_companies(self, save_lunch_groups):
+        companies = CompanyFactory.create_batch(3)
+        for company in companies:
+            EmployeeFactory.create_batch(4, company=company)
+        Lunch.objects.create(company=companies[0], date=timezone.localdate())
+        save_lunch_groups.side_effect = [Exception('Failed'), None]
+
+        timings = match_companies([c.pk for c in companies])
+        # Company with lunch today is skipped, failure of one company doesn't stop the others
+        self.assertEqual(set(timings), {companies[1].pk, companies[2].pk})
+        self.assertEqual(
+            {call[0][0] for call in save_lunch_groups.call_args_list}, {companies[1], companies[2]})
+
+    def test_match_companies_by_employee_ids(self):
+        company = CompanyFactory.create()
+        employees = EmployeeFactory.create_batch(7, company=company)
+        Employee.objects.filter(pk=employees[0].pk).update(state=Employee.State.offline)
+        online_ids = {e.pk for e in employees[1:]}
+        self.assertEqual(set(get_online_employee_ids(company)), online_ids)
+
+        match_companies([company.pk])
+        groups = [
+            {m.employee_id for m in group.members.all()}
+            for group in LunchGroup.objects.filter(lunch__company=company)
+        ]
+        # Offline employee isn't matched, positions of matcher are mapped back to employee ids
+        self.assertEqual(set().union(*groups), online_ids)
+        self.assertEqual(sorted(len(g) for g in groups), [2, 2, 2])
+
+
+class BenchmarkMatcherTestCase(TestCase):
+    def test_benchmark(self):
+        out = StringIO()
+        call_command('benchmark_matcher', '--sizes', '11', '--weeks', '2', '--seed', '1', stdout=out)
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(results), 6)
+        for result in results:
+            self.assertEqual((result['size'], result['employees'], result['groups']), (11, 11, 5))
+            self.assertEqual(result['queries'], 1)
+            self.assertLessEqual(0, result['repeat_rate'])
+        self.assertFalse(Company.objects.exists())
+
+
+class SyntheticCompaniesTestCase(TestCase):
+    def test_delete_synthetic_companies(self):
+        company = create_synthetic_company(4, 1, with_telegram=True)
+        real_company = CompanyFactory.create(name='synthetic-real')
+        real_employee = EmployeeFactory.create(company=real_company)
+        # User of a synthetic company who joined a real one is kept
+        shared_user = company.employee_set.first().user
+        EmployeeFactory.create(company=real_company, user=shared_user)
+        self.assertFalse(any(uid.lstrip('-').isdigit() for uid in company.employees.values_list('telegram_uid', flat=True)))
+
+        delete_synthetic_companies()
+        self.assertEqual(list(Company.objects.all()), [real_company])
+        self.assertEqual(
+            set(User.objects.values_list('pk', flat=True)),
+            {real_company.owner_id, real_employee.user_id, shared_user.pk})
+
+    @mock.patch('core.tasks.match_companies')
+    @mock.patch('core.tasks.liveness_registry')
+    def test_synthetic_companies_skipped_by_real_runs(self, liveness_registry, match_companies):
+        synthetic_company = create_synthetic_company(2, 0, with_telegram=True)
+        real_company = CompanyFactory.create()
+        liveness_registry.get_alive.return_value = set(
+            synthetic_company.employees.values_list('telegram_uid', flat=True))
+
+        create_lunch_groups()
+        match_companies.delay.assert_called_once_with([real_company.pk], None)
+        create_lunch_groups(company_ids=[synthetic_company.pk])
+        match_companies.delay.assert_called_with([synthetic_company.pk], None)
+
+    def test_synthetic_outbox_skipped_by_real_senders(self):
+        synthetic_company = create_synthetic_company(2, 0, with_telegram=True)
+        save_lunch_groups(synthetic_company, [list(synthetic_company.employee_set.values_list('pk', flat=True))])
+        real_message = OutboxMessage.objects.create(chat_id='1', text='Hi')
+
+        with mock.patch('core.tasks.send_outbox_messages', return_value=None) as send_outbox_messages:
+            send_outbox()
+        send_outbox_messages.assert_called_once_with([real_message])
+
+
+class RunEverythingTestCase(TestCase):
+    def test_dry_run_with_real_messages(self):
+        OutboxMessage.objects.create(chat_id='1', text='Hi')
+        with self.assertRaises(CommandError):
+            call_command('run_everything', '--dry-run', '--eager')
+
+    @override_settings(TELEGRAM_DRY_RUN=True)
+    @mock.patch('core.management.commands.run_everything.celery_app')
+    def test_dry_run_with_real_workers(self, celery_app):
+        celery_app.control.broadcast.return_value = [{'worker@1': {'ok': True}}, {'worker@2': {'ok': False}}]
+        with self.assertRaisesMessage(CommandError, 'worker@2'):
+            call_command('run_everything', '--dry-run')
+        self.assertFalse(Company.objects.exists())
+
+
+class SaveLunchGroupsTestCase(TestCase):
+    def test_save_lunch_groups(self):
+        query_counts = []
+        for size in [3, 41]:
+            company = CompanyFactory.create()
+            employees = EmployeeFactory.create_batch(size, company=company)
+            groups = [[e.pk for e in employees[i:i + 2]] for i in range(0, size - 1, 2)]
+            groups[-1].append(employees[-1].pk)
+            with CaptureQueriesContext(connection) as queries:
+                member_ids = save_lunch_groups(company, groups)
+            query_counts.append(len(queries))
+
+            self.assertEqual(len(member_ids), size)
+            members = LunchGroupMember.objects.filter(pk__in=member_ids)
+            self.assertEqual(
+                {frozenset(m.employee_id for m in g.members.all()) for g in LunchGroup.objects.filter(lunch__company=company)},
+                {frozenset(g) for g in groups})
+            self.assertEqual(set(members.values_list('employee_id', flat=True)), {e.pk for e in employees})
+        self.assertEqual(query_counts[0], query_counts[1])
+
+
+class NotificationsTestCase(TestCase):
+    def test_render_notifications(self):
+        company = CompanyFactory.create()
+        employees = EmployeeFactory.create_batch(41, company=company)
+        for employee in employees[1:]:
+            employee.user.telegram_uid = str(employee.user.pk)
+            employee.user.save()
+        groups = [[e.pk for e in employees[i:i + 2]] for i in range(0, 40, 2)]
+        groups[-1].append(employees[-1].pk)
+        member_ids = save_lunch_groups(company, groups)
+
+        with self.assertNumQueries(1):
+            notifications = render_notifications(member_ids)
+        # First employee has no Telegram account
+        self.assertEqual(len(notifications), 40)
+        uid, message = notifications[LunchGroupMember.objects.get(employee=employees[1]).pk]
+        self.assertEqual(uid, str(employees[1].user_id))
+        self.assertIn(f'(@{employees[0].user.username} - ', message)
+        # Partner without Telegram account isn't linked
+        self.assertIn(f'here: {employees[0].get_full_name()} (@', message)
+        self.assertNotIn('tg://user?id=None', message)
+        _, message = notifications[LunchGroupMember.objects.get(employee=employees[-1]).pk]
+        self.assertIn(f'tg://user?id={employees[-2].user.pk}', message)
+        self.assertIn(f'tg://user?id={employees[-3].user.pk}', message)
+
+        # Notifications are put to the outbox together with lunch groups
+        self.assertEqual(OutboxMessage.objects.pending().count(), 40)
+        self.assertEqual(OutboxMessage.objects.get(lunch_group_member__employee=employees[1]).chat_id, uid)
+
+
+def make_api_exception(status_code, content=b'{}'):
+    response = Response()
+    response.status_code, response._content = status_code, content
+    return ApiException('Error', 'sendChatAction', response)
+
+
+class CheckEmployeesInTelegramTestCase(TestCase):
+    @override_settings(TELEGRAM_PROBE_CHUNK_SIZE=2)
+    @mock.patch('core.tasks.match_companies')
+    @mock.patch('core.tasks.celery.group')
+    @mock.patch('core.tasks.check_employees_in_telegram.si')
+    @mock.patch('core.tasks.liveness_registry')
+    def test_chunks(self, liveness_registry, check_employees_si, group, match_companies):
+        company = CompanyFactory.create()
+        employees = EmployeeFactory.create_batch(5, company=company)
+        liveness_registry.get_alive.return_value = set()
+
+        create_lunch_groups(company_ids=[company.pk])
+        chunks = [call[0][0] for call in check_employees_si.call_args_list]
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual({pk for chunk in chunks for pk in chunk}, {e.pk for e in employees})
+        match_companies.si.assert_called_once_with([company.pk], None)
+
+    @mock.patch('core.tasks.liveness_registry')
+    def test_check_employees(self, liveness_registry):
+        employees = EmployeeFactory.create_batch(4)
+        for i, employee in enumerate(employees[:3]):
+            employee.user.telegram_uid = str(i)
+            employee.user.save()
+        liveness_registry.probe_many.return_value = (
+            {'0'}, {'1'}, {'2': make_api_exception(429, b'{"parameters": {"retry_after": 3}}')})
+
+        with mock.patch.object(check_employees_in_telegram, 'retry', side_effect=Retry()) as retry:
+            check_employees_in_telegram.apply(args=([e.pk for e in employees],))
+            retry.assert_called_once_with(args=([employees[2].pk], None), countdown=3)
+            liveness_registry.probe_many.assert_called_with({'0', '1', '2'}, settings.TELEGRAM_PROBE_THREADS)
+
+            # Task succeeds when retries are exhausted, so that lunches are created anyway
+            result = check_employees_in_telegram.apply(
+                args=([employees[2].pk],), retries=check_employees_in_telegram.max_retries)
+            self.assertTrue(result.successful())
+            self.assertEqual(retry.call_count, 1)
+        states = dict(Employee.objects.values_list('pk', 'state'))
+        self.assertEqual(
+            [states[e.pk] for e in employees], ['online', 'offline', 'online', 'offline'])
+
+    @mock.patch('core.tasks.liveness_registry')
+    def test_check_employees_errors(self, liveness_registry):
+        employee = EmployeeFactory.create(user__telegram_uid='0')
+        liveness_registry.probe_many.return_value = (set(), set(), {'0': ConnectionError()})
+        self.assertTrue(check_employees_in_telegram.apply(args=([employee.pk],)).successful())
+        self.assertEqual(liveness_registry.probe_many.call_count, 1)
+        employee.refresh_from_db()
+        self.assertEqual(employee.state, 'online')
+
+        liveness_registry.probe_many.side_effect = Exception('Failed')
+        self.assertTrue(check_employees_in_telegram.apply(args=([employee.pk],)).successful())
+
+
+class LivenessRegistryTestCase(TestCase):
+    @mock.patch('core.telegram.liveness.get_redis')
+    def test_get_alive(self, get_redis):
+        redis = get_redis.return_value
+        registry = LivenessRegistry()
+        redis.mget.return_value = [b'1', None, None, None]
+        TelegramChat.objects.create(uid='2', chat_id='2')
+        OutboxMessage.objects.create(chat_id='3', text='Hi', sent_at=timezone.now())
+        OutboxMessage.objects.create(
+            chat_id='4', text='Hi', sent_at=timezone.now() - timedelta(seconds=registry.ttl + 1))
+
+        self.assertEqual(registry.get_alive([1, 2, 3, 4]), {'1', '2', '3'})
+        redis.mget.assert_called_once_with(['alive:1', 'alive:2', 'alive:3', 'alive:4'])
+        marked = {call[0][0] for call in redis.pipeline.return_value.set.call_args_list}
+        self.assertEqual(marked, {'alive:2', 'alive:3'})
+
+    @mock.patch('core.telegram.liveness.bot')
+    @mock.patch('core.telegram.liveness.get_redis')
+    def test_probe(self, get_redis, bot):
+        pipeline = get_redis.return_value.pipeline.return_value
+        registry = LivenessRegistry()
+        self.assertTrue(registry.probe('1'))
+        # Mark expires after TTL
+        pipeline.set.assert_called_once_with('alive:1', 1, ex=registry.ttl)
+
+        bot.send_chat_action.side_effect = make_api_exception(403)
+        self.assertFalse(registry.probe('2'))
+        self.assertEqual(pipeline.set.call_count, 1)
+
+        bot.send_chat_action.side_effect = make_api_exception(500)
+        with self.assertRaises(ApiException):
+            registry.probe('3')
+
+    @mock.patch('core.telegram.liveness.get_redis')
+    def test_touch(self, get_redis):
+        redis = get_redis.return_value
+        registry = LivenessRegistry()
+        registry.touch(1)
+        registry.touch('1')
+        redis.set.assert_called_once_with('alive:1', 1, ex=registry.ttl, nx=True)
+
+        redis.set.side_effect = RedisError
+        with self.assertLogs(level='ERROR'):
+            registry.touch(2)
+
+    @mock.patch('core.telegram.liveness.bot')
+    @mock.patch('core.telegram.liveness.get_redis')
+    def test_probe_many(self, get_redis, bot):
+        def send_chat_action(uid, action):
+            if uid == '1':
+                raise make_api_exception(403)
+            if uid == '2':
+                raise ConnectionError()
+
+        bot.send_chat_action.side_effect = send_chat_action
+        registry = LivenessRegistry()
+        alive, dead, errors = registry.probe_many(['0', '1', '2'], max_workers=2)
+        self.assertEqual((alive, dead, set(errors)), ({'0'}, {'1'}, {'2'}))
+        self.assertIsInstance(errors['2'], ConnectionError)
+        get_redis.return_value.pipeline.return_value.set.assert_called_once_with('alive:0', 1, ex=registry.ttl)
+
+
+class SendOutboxTestCase(TestCase):
+    @mock.patch('core.tasks.liveness_registry')
+    @mock.patch('core.tasks.bot')
+    def test_send_outbox(self, bot, liveness_registry):
+        bot.send_message.side_effect = [mock.Mock(message_id=1), make_api_exception(403)]
+        sent, failed, claimed = [OutboxMessage.objects.create(chat_id=str(i), text='Hi') for i in range(3)]
+        OutboxMessage.objects.filter(pk=claimed.pk).update(claimed_until=timezone.now() + timedelta(minutes=1))
+
+        send_outbox()
+        # Message claimed by another sender is skipped
+        self.assertEqual([call[0][0] for call in bot.send_message.call_args_list], ['0', '1'])
+        sent.refresh_from_db()
+        failed.refresh_from_db()
+        self.assertEqual((sent.message_id, sent.claimed_until, sent.error), (1, None, ''))
+        self.assertIsNone(failed.sent_at)
+        self.assertNotEqual(failed.error, '')
+        self.assertEqual(list(OutboxMessage.objects.pending()), [claimed])
+        liveness_registry.mark_alive.assert_called_once_with('0')
+
+    @mock.patch('core.tasks.send_outbox.apply_async')
+    @mock.patch('core.tasks.liveness_registry')
+    @mock.patch('core.tasks.bot')
+    def test_send_outbox_rate_limited(self, bot, liveness_registry, apply_async):
+        bot.send_message.side_effect = make_api_exception(429, b'{"parameters": {"retry_after": 5}}')
+        message = OutboxMessage.objects.create(chat_id='0', text='Hi')
+
+        send_outbox()
+        apply_async.assert_called_once_with(kwargs=dict(batch_size=100, run_id=None, company_id=None), countdown=5)
+        # Claim is released, so the message is sent by the next sender
+        self.assertEqual(list(OutboxMessage.objects.claimable()), [message])
+
+
+class RateLimiterTestCase(TestCase):
+    def test_get_retry_after(self):
+        for status_code, content, retry_after in [
+            (429, b'{"ok": false, "error_code": 429, "parameters": {"retry_after": 7}}', 7),
+            (429, b'Too Many Requests', 1),
+            (403, b'{"ok": false, "error_code": 403}', None),
+        ]:
+            response = Response()
+            response.status_code, response._content = status_code, content
+            self.assertEqual(get_retry_after(ApiException('Error', 'sendMessage', response)), retry_after)
+
+    def test_interactive_timeout(self):
+        rate_limiter = mock.Mock()
+        bot = RateLimitedTeleBot('0:test', rate_limiter, interactive_timeout=5, threaded=False)
+        bot.message_handler(content_types=['text'])(lambda message: bot.send_message(message.chat.id, 'Hi'))
+        update = telebot.types.Update.de_json({
+            'update_id': 1,
+            'message': {
+                'message_id': 1, 'date': 0, 'text': 'Hi',
+                'from': {'id': 100, 'is_bot': False, 'first_name': 'John'}, 'chat': {'id': 100, 'type': 'private'},
+            },
+        })
+        stub = TelegramStub()
+        stub.install()
+        try:
+            # Reply which can't be sent in time is dropped
+            rate_limiter.acquire.side_effect = RateLimitTimeout('Timeout')
+            bot.process_new_updates([update])
+            rate_limiter.acquire.assert_called_once_with(100, timeout=5)
+
+            rate_limiter.acquire.side_effect = None
+            bot.send_message(100, 'Hi')
+            rate_limiter.acquire.assert_called_with(100, timeout=None)
+            self.assertEqual(stub.calls['sendMessage'], 1)
+        finally:
+            stub.uninstall()
+
+
+class InstrumentationTestCase(TestCase):
+    @mock.patch('core.utils.get_redis')
+    def test_stage(self, get_redis):
+        company = CompanyFactory.create()
+        EmployeeFactory.create_batch(3, company=company)
+        run = PipelineRun.objects.create()
+        with stage('test', run.pk, company.pk):
+            list(company.employee_set.all())
+            company.employee_set.update(state='offline')
+            record_telegram_call()
+            record_telegram_call(error=True)
+
+        pipeline_stage = run.stages.get()
+        self.assertEqual((pipeline_stage.name, pipeline_stage.company), ('test', company))
+        self.assertEqual((pipeline_stage.queries, pipeline_stage.rows_written), (2, 3))
+        self.assertEqual((pipeline_stage.telegram_calls, pipeline_stage.telegram_errors), (2, 1))
+        self.assertGreater(pipeline_stage.duration, 0)
+        get_redis.return_value.pipeline.return_value.execute.assert_called_once()
+
+    @override_settings(METRICS_TOKEN='secret')
+    @mock.patch('core.views.render_metrics', return_value='')
+    def test_metrics_access(self, render_metrics):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+        self.client.force_login(User.objects.create(username='admin', is_staff=True))
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+
+class TelegramStubTestCase(TestCase):
+    def test_stub(self):
+        stub = TelegramStub()
+        message = stub.make_request('token', 'sendMessage', 'post', params={'chat_id': 1, 'text': 'Hello'})
+        self.assertEqual((message['message_id'], message['chat']['id'], message['text']), (1, 1, 'Hello'))
+        self.assertIs(stub.make_request('token', 'sendChatAction', 'post', params={'chat_id': 1}), True)
+
+        for stub, status_code, retry_after in [
+            (TelegramStub(too_many_requests_rate=1, retry_after=3), 429, 3),
+            (TelegramStub(forbidden_rate=1), 403, None),
+        ]:
+            with self.assertRaises(ApiException) as cm:
+                stub.make_request('token', 'sendMessage', 'post', params={'chat_id': 1, 'text': 'Hello'})
+            self.assertEqual(cm.exception.result.status_code, status_code)
+            self.assertEqual(get_retry_after(cm.exception), retry_after)
+            self.assertEqual(stub.errors[status_code], 1)
+
+
+class UpdatesQueueTestCase(TestCase):
+    def test_validate_update(self):
+        self.assertEqual(validate_update('{"update_id": 1}'), {'update_id': 1})
+        for json_string in ['{"update_id": ', '[]', '{"message": {}}']:
+            with self.assertRaises(InvalidUpdate):
+                validate_update(json_string)
+
+    @override_settings(TELEGRAM_UPDATES_QUEUE=True)
+    def test_webhook(self):
+        response = self.client.post(reverse('webhook'), '{"message": {}}', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(TELEGRAM_UPDATES_QUEUE=True)
+    @mock.patch('core.telegram.updates.get_redis')
+    @mock.patch('core.views.seen_updates')
+    def test_webhook_pushes_updates(self, seen_updates, get_redis):
+        seen_updates.add.return_value = True
+        json_string = '{"update_id": 1, "message": {}}'
+        with mock.patch('core.views.update_queue', UpdateQueue()):
+            response = self.client.post(reverse('webhook'), json_string, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        get_redis.return_value.rpush.assert_called_once_with(UPDATES_KEY, json_string)
+
+    @override_settings(TELEGRAM_UPDATES_QUEUE=True)
+    @mock.patch('core.views.update_queue')
+    @mock.patch('core.views.seen_updates')
+    def test_webhook_duplicates(self, seen_updates, update_queue):
+        seen_updates.add.side_effect = [True, False]
+        for _ in range(2):
+            response = self.client.post(reverse('webhook'), '{"update_id": 1}', content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+        update_queue.push.assert_called_once_with('{"update_id": 1}')
+
+    @mock.patch('core.views.bot')
+    @mock.patch('core.views.seen_updates')
+    def test_webhook_failed_update(self, seen_updates, bot):
+        seen_updates.add.return_value = True
+        bot.process_new_updates.side_effect = ValueError
+        with self.assertRaises(ValueError):
+            self.client.post(reverse('webhook'), '{"update_id": 1}', content_type='application/json')
+        seen_updates.discard.assert_called_once_with(1)
+
+    @mock.patch('core.management.commands.poll_updates.process_updates')
+    @mock.patch('core.management.commands.poll_updates.bot')
+    def test_poll_updates_advances_offset_on_errors(self, bot, process_updates):
+        updates = [telebot.types.Update.de_json({'update_id': i}) for i in [1, 2]]
+        bot.get_updates.side_effect = [updates, KeyboardInterrupt]
+        process_updates.side_effect = ValueError
+        with self.assertRaises(KeyboardInterrupt):
+            call_command('poll_updates', '--timeout', '0')
+        process_updates.assert_called_once_with(updates)
+        self.assertEqual(bot.get_updates.call_args[1]['offset'], 3)
+
+
+class PrefetchUpdatesTestCase(TestCase):
+    def test_prefetch_updates(self):
+        user = EmployeeFactory.create(user__telegram_uid='100').user
+        updates = [
+            telebot.types.Update.de_json({
+                'update_id': i,
+                'message': {
+                    'message_id': i, 'date': 0, 'text': '/groups',
+                    'from': {'id': uid, 'is_bot': False, 'first_name': 'John'},
+                    'chat': {'id': uid, 'type': 'private'},
+                },
+            })
+            for i, uid in enumerate([100, 200, 100])
+        ]
+        with self.assertNumQueries(3), prefetch_updates(updates):
+            self.assertEqual(get_prefetched_users(), {'100': user, '200': None})
+        self.assertEqual(get_prefetched_users(), {})
+        self.assertEqual(set(TelegramChat.objects.values_list('uid', flat=True)), {'100', '200'})
+
+
+class TelegramUserCacheTestCase(TestCase):
+    @mock.patch('core.telegram.user_cache.telegram_user_cache')
+    def test_invalidate_user(self, telegram_user_cache):
+        user = User.objects.create(username='john', telegram_uid='1')
+        telegram_user_cache.reset_mock()
+        user.telegram_uid = '2'
+        user.save()
+        self.assertEqual({call[0][0] for call in telegram_user_cache.invalidate.call_args_list}, {'1', '2'})
+
+    @mock.patch('core.telegram.user_cache.get_redis')
+    def test_redis_unavailable(self, get_redis):
+        redis = get_redis.return_value
+        redis.get.side_effect = redis.set.side_effect = redis.exists.side_effect = RedisError
+        cache = TelegramUserCache()
+        with mock.patch('core.telegram.user_cache.telegram_user_cache'):
+            user = User.objects.create(username='john', telegram_uid='1')
+
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(cache.get_user(1), user)
+            self.assertFalse(cache.is_chat_known(1))
+            cache.add_chat(1)
+        self.assertTrue(cache.is_chat_known(1))
+
+
+class LRUCacheTestCase(TestCase):
+    def test_eviction(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', None)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b', 'missing'), 'missing')
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+
+class StateRegistryTestCase(TestCase):
+    @mock.patch('core.telegram.state_registry.get_redis')
+    def test_process_message(self, get_redis):
+        registry = StateRegistry()
+        handler = mock.Mock()
+        registry.register('answer')(handler)
+        message = mock.Mock(**{'from_user.id': 100})
+        pipeline = get_redis.return_value.pipeline.return_value
+
+        pipeline.execute.return_value = [b'answer', 1]
+        registry.process_message(message)
+        handler.assert_called_once_with(message)
+        pipeline.get.assert_called_once_with('state:100')
+        pipeline.delete.assert_called_once_with('state:100')
+        get_redis.return_value.set.assert_not_called()
+
+        # Failed handler doesn't lose the state
+        handler.side_effect = ValueError
+        with self.assertRaises(ValueError):
+            registry.process_message(message)
+        get_redis.return_value.set.assert_called_once_with('state:100', 'answer', ex=registry.state_ttl, nx=True)
+
+        pipeline.execute.return_value = [None, 0]
+        with self.assertRaises(NoStateException):
+            registry.process_message(message)
+
+
+class MembershipCacheTestCase(TestCase):
+    @mock.patch('core.telegram.memberships.get_redis')
+    def test_get(self, get_redis):
+        cache = MembershipCache()
+        redis = get_redis.return_value
+        employee = EmployeeFactory.create(state='offline')
+        company = employee.company
+
+        redis.hgetall.return_value = {}
+        with self.assertNumQueries(1):
+            self.assertEqual(cache.get(employee.user_id), [Membership(company.pk, company.name, 'offline')])
+
+        redis.hgetall.return_value = {
+            b'loaded': b'1', f'name:{company.pk}'.encode(): company.name.encode(), f'state:{company.pk}'.encode(): b'online',
+        }
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get(employee.user_id), [Membership(company.pk, company.name, 'online')])
+
+
+class RouterTestCase(TestCase):
+    def test_dispatch(self):
+        router = Router()
+        start, online, fallback = mock.Mock(), mock.Mock(), mock.Mock()
+        router.command('help', 'start')(start)
+        router.callback('online')(online)
+        router.fallback(fallback)
+
+        for text, handler in [('/start', start), ('/start@lunchegram_bot', start), ('/unknown', fallback), ('token', fallback)]:
+            message = mock.Mock(text=text)
+            router.dispatch_message(message)
+            handler.assert_called_with(message)
+        self.assertEqual((start.call_count, fallback.call_count), (2, 2))
+
+        query = mock.Mock(data='online:5')
+        router.dispatch_callback_query(query)
+        online.assert_called_once_with(query, '5')
+        bot = mock.Mock()
+        router.install(bot)
+        router.dispatch_callback_query(mock.Mock(id='1', data='offline:5'))
+        self.assertEqual(online.call_count, 1)
+        # Unknown callback is answered anyway
+        bot.answer_callback_query.assert_called_once_with('1')
+
+
+class CoalesceCallbackQueriesTestCase(TestCase):
+    @mock.patch('core.telegram.decorators.bot')
+    @mock.patch('core.telegram.decorators.callback_coalescer')
+    def test_coalesce(self, callback_coalescer, bot):
+        callback_coalescer.is_first_press.side_effect = [True, False]
+        handler = mock.Mock()
+        wrapped = coalesce_callback_queries()(handler)
+        query = mock.Mock(**{'id': '1', 'data': 'online:5', 'from_user.id': 100, 'message.message_id': 7})
+
+        wrapped(query, '5')
+        wrapped(query, '5')
+        handler.assert_called_once_with(query, '5')
+        callback_coalescer.is_first_press.assert_called_with(100, 7, 'online:5')
+        bot.answer_callback_query.assert_called_once_with('1', show_alert=False)
@@ -5,6 +5,7 @@ from . import views
 
 urlpatterns = [
     path(f'webhook/{settings.WEBHOOK_URL_SECRET}/', views.webhook, name='webhook'),
+    path('metrics/', views.metrics, name='metrics'),
     path('dashboard/', views.DashboardView.as_view(), name='dashboard'),
     path('companies/add/', views.CompanyCreateView.as_view(), name='company_add'),
     path('companies/<int:pk>/', views.CompanyDetailView.as_view(), name='company_detail'),
@@ -1,3 +1,5 @@
+import threading
+
 from django.conf import settings
 from redis import Redis
 from accounts.models import User
@@ -6,8 +8,24 @@ from api.kit_hr import get_kit_hr_client
 FIRED_STATUSES = ['NEVER_WORK', 'IN_DISMISS', 'DISMISSED']
 
 
-def get_redis():
-    return Redis.from_url(settings.REDIS_URL)
+_redis_clients = {}
+_redis_lock = threading.Lock()
+
+
+def get_redis(url: str = None) -> Redis:
+    """
+    Returns Redis client shared by the process, so that all its users take connections from the same pool.
+    The pool checks pid before giving out a connection and reconnects in forked processes
+    (Celery prefork and uWSGI workers), so clients created before fork are safe to use.
+    """
+    url = url or settings.REDIS_URL
+    client = _redis_clients.get(url)
+    if client is None:
+        with _redis_lock:
+            client = _redis_clients.get(url)
+            if client is None:
+                client = _redis_clients[url] = Redis.from_url(url)
+    return client
 
 
 def kokoc_users_sync():
@@ -1,18 +1,23 @@
+import hmac
+
 import telebot
+from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.http import HttpResponse, Http404
 from django.shortcuts import redirect
 from django.urls import reverse
 from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_POST, require_GET
 from django.views.generic import TemplateView, CreateView, DetailView, UpdateView
 from django.utils.translation import gettext as _
 
 from core.forms import CompanyForm
+from core.instrumentation import render_metrics
 from core.models import Company, Employee
 # from core.tables import LunchScheduleTable
 from core.tasks import send_telegram_message
+from core.telegram.updates import update_queue, seen_updates, validate_update, InvalidUpdate
 from lunchegram import bot
 
 
@@ -96,7 +101,7 @@ class InviteConfirmView(LoginRequiredMixin, DetailView):
             company=company,
             user=request.user,
         )[0]
-        if request.user.has_telegram and request.user.telegram_account:
+        if request.user.has_telegram and request.user.telegram_uid:
             send_telegram_message.delay(
                 request.user.pk,
                 _("Hi! You've successfully joined lunch group «{}». "
@@ -149,6 +154,20 @@ class InviteSuccessView(LoginRequiredMixin, DetailView):
 #         return reverse('company_detail', args=(self.company.pk,))
 
 
+##### Metrics
+
+
+@never_cache
+@require_GET
+def metrics(request):
+    """Pipeline stage metrics for Prometheus"""
+    token = request.headers.get('authorization', '')
+    has_token = bool(settings.METRICS_TOKEN) and hmac.compare_digest(token, f'Bearer {settings.METRICS_TOKEN}')
+    if not has_token and not request.user.is_staff:
+        return HttpResponse(status=403)
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 ##### Telegram webhooks
 
 
@@ -158,8 +177,27 @@ class InviteSuccessView(LoginRequiredMixin, DetailView):
 def webhook(request):
     if request.headers.get('content-type') == 'application/json':
         json_string = request.body.decode('utf-8')
+        if settings.TELEGRAM_UPDATES_QUEUE:
+            # Updates are processed by `process_updates` command
+            try:
+                data = validate_update(json_string)
+            except InvalidUpdate:
+                return HttpResponse(status=400)
+            if seen_updates.add(data['update_id']):
+                try:
+                    update_queue.push(json_string)
+                except Exception:
+                    seen_updates.discard(data['update_id'])
+                    raise
+            return HttpResponse()
         update = telebot.types.Update.de_json(json_string)
-        bot.process_new_updates([update])
+        if seen_updates.add(update.update_id):
+            try:
+                bot.process_new_updates([update])
+            except Exception:
+                # Telegram delivers the update again after error response
+                seen_updates.discard(update.update_id)
+                raise
         return HttpResponse()
     else:
         return HttpResponse(status=400)
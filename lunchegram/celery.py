@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.worker.control import inspect_command
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lunchegram.settings')
 
@@ -18,3 +19,11 @@ app.autodiscover_tasks()
 @app.task(bind=True)
 def debug_task(self):
     print('Request: {0!r}'.format(self.request))
+
+
+@inspect_command()
+def telegram_dry_run(state):
+    """Tells if the worker talks to Telegram stub, `run_everything --dry-run` checks all workers with it."""
+    from django.conf import settings
+
+    return {'ok': bool(settings.TELEGRAM_DRY_RUN)}
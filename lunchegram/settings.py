@@ -33,6 +33,9 @@ env = environ.Env(
     WEBHOOK_URL_SECRET=str,
     SENTRY_DSN=(str, ''),
     KIT_API_KEY=(str, ''),
+    TELEGRAM_DRY_RUN=(bool, False),
+    TELEGRAM_UPDATES_QUEUE=(bool, False),
+    METRICS_TOKEN=(str, ''),
 )
 
 env.read_env()
@@ -186,6 +189,7 @@ SOCIAL_AUTH_PIPELINE = (
     'social_core.pipeline.user.create_user',
     'accounts.pipeline.mark_telegram_user',
     'accounts.pipeline.fill_telegram_chat_id',
+    'accounts.pipeline.fill_telegram_uid',
     'social_core.pipeline.social_auth.associate_user',
     'social_core.pipeline.social_auth.load_extra_data',
     'social_core.pipeline.user.user_details',
@@ -198,6 +202,9 @@ WEBHOOK_BASE_URL = env('WEBHOOK_BASE_URL')
 
 WEBHOOK_URL_SECRET = env('WEBHOOK_URL_SECRET')
 
+# Prometheus has to send it as `Authorization: Bearer <token>`, staff users may see metrics without it
+METRICS_TOKEN = env('METRICS_TOKEN')
+
 
 # Crispy forms
 
@@ -222,14 +229,79 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'core.tasks.run_everything',
         'schedule': crontab(day_of_week='1', hour='18', minute='0'),  # Every monday at 6PM
     },
+    'send-outbox': {
+        'task': 'core.tasks.send_outbox',
+        'schedule': 60,  # Resumes sending if a sender has crashed
+    },
+}
+
+# CPU heavy matching is processed by a separate worker, see confs/supervisor.example.conf
+CELERY_TASK_ROUTES = {
+    'core.tasks.match_companies': {'queue': 'matching'},
 }
 
 
+# Pair matcher
+
+# Companies of this size and bigger are matched on a sparse graph of best candidate partners
+PAIR_MATCHER_SPARSE_THRESHOLD = 300
+
+PAIR_MATCHER_SPARSE_K = 20
+
+PAIR_MATCHER_SPARSE_RANDOM = 3
+
+# Bigger companies are always matched with greedy algorithm
+PAIR_MATCHER_BLOSSOM_MAX_SIZE = 2000
+
+# Seconds blossom matching may take before greedy matching is used instead
+PAIR_MATCHER_TIME_BUDGET = 60
+
+# Size of process pool companies are matched in, defaults to number of CPUs
+PAIR_MATCHER_PROCESSES = None
+
+
 # Redis
 
 REDIS_URL = 'redis://localhost:6379/0'
 
 
+# Telegram rate limits shared by all processes, messages per second
+
+TELEGRAM_GLOBAL_RATE_LIMIT = 30
+
+TELEGRAM_CHAT_RATE_LIMIT = 1
+
+# Seconds replies to updates wait for rate limits before they are dropped
+TELEGRAM_INTERACTIVE_RATE_LIMIT_TIMEOUT = 5
+
+# Seconds users who interacted with the bot or received a message aren't probed before lunches
+TELEGRAM_LIVENESS_TTL = 3 * 24 * 60 * 60
+
+# Employees probed by one task and threads probing them
+TELEGRAM_PROBE_CHUNK_SIZE = 200
+
+TELEGRAM_PROBE_THREADS = 8
+
+# Routes all bot calls to an in-process stub, see `core.telegram.stub` and `run_everything --dry-run`.
+# Has to be enabled for Celery workers too.
+TELEGRAM_DRY_RUN = env('TELEGRAM_DRY_RUN')
+
+TELEGRAM_STUB_LATENCY = 0.05
+
+TELEGRAM_STUB_TOO_MANY_REQUESTS_RATE = 0.01
+
+TELEGRAM_STUB_FORBIDDEN_RATE = 0.01
+
+# Webhook puts updates to Redis queue and returns at once, `process_updates` command has to be running then
+TELEGRAM_UPDATES_QUEUE = env('TELEGRAM_UPDATES_QUEUE')
+
+# Seconds to remember received update ids, re-delivered updates are dropped by the webhook
+TELEGRAM_SEEN_UPDATES_TTL = 15 * 60
+
+# Seconds in which repeated presses of the same inline button are only answered
+TELEGRAM_CALLBACK_COALESCE_WINDOW = 2
+
+
 # Sentry logging
 
 sentry_sdk.init(
@@ -1,5 +1,74 @@
+import logging
+import threading
+
 import telebot
 from django.conf import settings
+from redis import Redis
+
+from core.instrumentation import record_telegram_call
+from core.rate_limiter import RateLimiter, RateLimitTimeout
+from core.telegram.stub import telegram_stub
+
+
+class RateLimitedTeleBot(telebot.TeleBot):
+    """
+    Waits for Telegram rate limits shared by all processes before sending messages.
+    Replies to updates wait at most `interactive_timeout` seconds and are dropped after that,
+    so that webhook requests don't hang, background tasks wait as long as needed.
+    """
+    def __init__(self, token, rate_limiter: RateLimiter, interactive_timeout: float = None, **kwargs):
+        super().__init__(token, **kwargs)
+        self.rate_limiter = rate_limiter
+        self.interactive_timeout = interactive_timeout
+        self._local = threading.local()
+
+    def process_new_updates(self, updates):
+        self._local.interactive = True
+        try:
+            super().process_new_updates(updates)
+        except RateLimitTimeout as e:
+            logging.warning(f'Reply was dropped: {e}')
+        finally:
+            self._local.interactive = False
+
+    def _call(self, method, chat_id, *args, **kwargs):
+        timeout = self.interactive_timeout if getattr(self._local, 'interactive', False) else None
+        self.rate_limiter.acquire(chat_id, timeout=timeout)
+        try:
+            result = method(chat_id, *args, **kwargs)
+        except Exception:
+            record_telegram_call(error=True)
+            raise
+        record_telegram_call()
+        return result
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self._call(super().send_message, chat_id, *args, **kwargs)
+
+    def send_chat_action(self, chat_id, *args, **kwargs):
+        return self._call(super().send_chat_action, chat_id, *args, **kwargs)
+
+    def edit_message_reply_markup(self, chat_id=None, *args, **kwargs):
+        return self._call(super().edit_message_reply_markup, chat_id, *args, **kwargs)
+
+
+# Stub traffic of dry runs doesn't take tokens of real messages
+RATE_LIMIT_PREFIX = 'ratelimit'
+DRY_RUN_RATE_LIMIT_PREFIX = 'ratelimit:dry-run'
+
+rate_limiter = RateLimiter(
+    Redis.from_url(settings.REDIS_URL),
+    global_rate=settings.TELEGRAM_GLOBAL_RATE_LIMIT,
+    chat_rate=settings.TELEGRAM_CHAT_RATE_LIMIT,
+    prefix=DRY_RUN_RATE_LIMIT_PREFIX if settings.TELEGRAM_DRY_RUN else RATE_LIMIT_PREFIX,
+)
 
+bot = RateLimitedTeleBot(
+    settings.SOCIAL_AUTH_TELEGRAM_BOT_TOKEN, rate_limiter, settings.TELEGRAM_INTERACTIVE_RATE_LIMIT_TIMEOUT,
+    threaded=False)
 
-bot = telebot.TeleBot(settings.SOCIAL_AUTH_TELEGRAM_BOT_TOKEN, threaded=False)
+if settings.TELEGRAM_DRY_RUN:
+    telegram_stub.latency = settings.TELEGRAM_STUB_LATENCY
+    telegram_stub.too_many_requests_rate = settings.TELEGRAM_STUB_TOO_MANY_REQUESTS_RATE
+    telegram_stub.forbidden_rate = settings.TELEGRAM_STUB_FORBIDDEN_RATE
+    telegram_stub.install()